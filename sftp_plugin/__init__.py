@@ -1,4 +1,6 @@
 from .columns import Group, Owner, Permissions
-from .commands import (CloseNetwork, EditFtpFile, EditSftpFile,
-                       NetworkListener, OpenFtp, OpenNetwork, OpenSftp, OpenSshTerminal)
+from .commands import (CalculateSftpSize, CloseNetwork, EditFtpFile, EditSftpFile,
+                       GrepSftp, GrepSftpFiles, NetworkListener, OpenFtp, OpenNetwork,
+                       OpenSftp, OpenSshTerminal, SearchSftp, ShowTransferDashboard,
+                       ShowTransferStatistics)
 from .filesystems import FtpFileSystem, NetworkFileSystem, SftpFileSystem
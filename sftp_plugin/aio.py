@@ -0,0 +1,501 @@
+import asyncio
+import concurrent.futures
+import socket
+import struct
+import time
+from functools import partial
+from ftplib import (error_perm, error_proto, error_reply, error_temp,
+                    parse227, parse229)
+from threading import Lock, Thread
+from urllib.parse import urlparse
+
+from .config import Config
+from .ftp import FtpBackgroundWrapper, ftpparser
+from .sftp import CONNECTION_ERRORS, SftpWrapper, paramiko
+
+from paramiko.sftp import (CMD_ATTRS, CMD_CLOSE, CMD_HANDLE, CMD_NAME,
+                           CMD_OPENDIR, CMD_READDIR, CMD_STAT, CMD_STATUS)
+
+
+class NetworkLoop():
+    #
+    # The optional asyncio core (Config.network_core = 'asyncio'): one
+    # event loop thread drives the SFTP sessions and the FTP control and
+    # data connections of all hosts. Work is submitted from any thread
+    # and comes back as a concurrent.futures.Future.
+    #
+    _loop = None
+    _lock = Lock()
+
+    @staticmethod
+    def is_enabled():
+        return Config.network_core == 'asyncio'
+
+    @staticmethod
+    def submit(coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, NetworkLoop.get_loop())
+
+    @staticmethod
+    def result(future, timeout):
+        # Waits for submitted work, which is canceled when it takes longer
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    @staticmethod
+    def call_soon(callback, *args):
+        # Runs callback on the loop thread, if the loop was ever started
+        loop = NetworkLoop._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(callback, *args)
+
+    @staticmethod
+    def get_loop():
+        with NetworkLoop._lock:
+            if NetworkLoop._loop is None:
+                # A selector loop on every platform, SFTP channels are watched by file descriptor
+                loop = asyncio.SelectorEventLoop()
+                Thread(target=NetworkLoop._run, args=(loop,), daemon=True).start()
+                NetworkLoop._loop = loop
+            return NetworkLoop._loop
+
+    @staticmethod
+    def _run(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+
+class AsyncSftpSession():
+    #
+    # An SFTP session read by the network loop instead of a thread. The
+    # channel's pipe wakes the loop when data arrives, and every reply
+    # resolves the future of its request number.
+    #
+
+    def __init__(self, client, loop):
+        self.closed = False
+        self._client = client
+        self._channel = client.get_channel()
+        self._loop = loop
+        self._futures = {}
+        self._buffer = b''
+        self._fileno = self._channel.fileno()
+        loop.add_reader(self._fileno, self._on_readable)
+
+    async def request(self, command, *args):
+        if self.closed:
+            raise paramiko.SSHException('Session closed')
+        # Requests are written from the loop thread, so no reply can beat its future
+        num = self._client._async_request(type(None), command, *args)
+        future = self._loop.create_future()
+        self._futures[num] = future
+        try:
+            return await asyncio.wait_for(future, Config.sftp_timeout)
+        except asyncio.TimeoutError:
+            # As the channel timeout of the threaded core, the session stays usable
+            raise socket.timeout('No reply from the server')
+        finally:
+            # A reply after a timeout or a cancel finds nobody waiting for it
+            self._futures.pop(num, None)
+            with self._client._lock:
+                self._client._expecting.pop(num, None)
+
+    async def stat(self, path):
+        t, msg = await self.request(CMD_STAT, self._client._adjust_cwd(path))
+        if t != CMD_ATTRS:
+            raise IOError('Expected attributes')
+        return paramiko.SFTPAttributes._from_msg(msg)
+
+    async def listdir_attr(self, path):
+        t, msg = await self.request(CMD_OPENDIR, self._client._adjust_cwd(path))
+        if t != CMD_HANDLE:
+            raise IOError('Expected handle')
+        handle = msg.get_binary()
+        files = []
+        try:
+            while True:
+                try:
+                    t, msg = await self.request(CMD_READDIR, handle)
+                except EOFError:
+                    break
+                if t != CMD_NAME:
+                    raise IOError('Expected name response')
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    attributes = paramiko.SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in ('.', '..'):
+                        files.append(attributes)
+        finally:
+            if not self.closed:
+                await self.request(CMD_CLOSE, handle)
+        return files
+
+    def close(self, failure=None):
+        if self.closed:
+            return
+        self.closed = True
+        self._loop.remove_reader(self._fileno)
+        failure = failure or paramiko.SSHException('Session closed')
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(failure)
+        self._futures.clear()
+        self._client.close()
+
+    def _on_readable(self):
+        try:
+            while self._channel.recv_ready():
+                self._buffer += self._channel.recv(65536)
+            dropped = self._channel.closed or self._channel.eof_received
+        except (OSError, paramiko.SSHException) as e:
+            self.close(paramiko.SSHException('Server connection dropped: {}'.format(e)))
+            return
+        while len(self._buffer) >= 4:
+            size, = struct.unpack('>I', self._buffer[:4])
+            if len(self._buffer) < 4 + size:
+                break
+            packet, self._buffer = self._buffer[4:4 + size], self._buffer[4 + size:]
+            self._dispatch(packet[0], paramiko.Message(packet[1:]))
+        if dropped and not self._channel.recv_ready():
+            self.close(paramiko.SSHException('Server connection dropped'))
+
+    def _dispatch(self, t, msg):
+        num = msg.get_int()
+        with self._client._lock:
+            self._client._expecting.pop(num, None)
+        future = self._futures.pop(num, None)
+        if future is None or future.done():
+            return
+        if t == CMD_STATUS:
+            try:
+                self._client._convert_status(msg)
+            except (IOError, EOFError) as error:
+                future.set_exception(error)
+                return
+        future.set_result((t, msg))
+
+
+class AsyncSftp():
+    #
+    # One loop driven session per host, opened on the host's SSH
+    # transport. Host maps are only touched from the loop thread.
+    #
+    _sessions = {}
+    _opening = {}
+
+    @staticmethod
+    def listdir_attr(host, path):
+        return NetworkLoop.submit(AsyncSftp._call(host, lambda session: session.listdir_attr(path)))
+
+    @staticmethod
+    def stat_all(host, paths):
+        # One result per path, failures as exceptions, as SftpBatch.run
+        async def stat_all(session):
+            return await asyncio.gather(*[session.stat(path) for path in paths], return_exceptions=True)
+        return NetworkLoop.submit(AsyncSftp._call(host, stat_all))
+
+    @staticmethod
+    def close_host(host):
+        NetworkLoop.call_soon(AsyncSftp._close_host, host)
+
+    @staticmethod
+    async def _call(host, operation):
+        # Like sftp_retry: reopens the session after a dropped connection
+        attempt = 0
+        while True:
+            session = await AsyncSftp._session(host)
+            try:
+                return await operation(session)
+            except CONNECTION_ERRORS:
+                if not session.closed or attempt == Config.sftp_retries:
+                    raise
+            await asyncio.sleep(Config.sftp_retry_delay * 2 ** attempt)
+            attempt += 1
+
+    @staticmethod
+    async def _session(host):
+        session = AsyncSftp._sessions.get(host)
+        if session is not None and not session.closed:
+            return session
+        if host not in AsyncSftp._opening:
+            AsyncSftp._opening[host] = asyncio.ensure_future(AsyncSftp._open(host))
+        return await asyncio.shield(AsyncSftp._opening[host])
+
+    @staticmethod
+    async def _open(host):
+        loop = NetworkLoop.get_loop()
+        try:
+            # The handshake is blocking paramiko code, prompts are left to the foreground connect
+            client = await loop.run_in_executor(None, SftpWrapper.connection, host, False, False)
+            session = AsyncSftp._sessions[host] = AsyncSftpSession(client, loop)
+            return session
+        finally:
+            del AsyncSftp._opening[host]
+
+    @staticmethod
+    def _close_host(host):
+        session = AsyncSftp._sessions.pop(host, None)
+        if session is not None:
+            session.close()
+
+
+class AsyncFtpConnection():
+    #
+    # An FTP control connection on the network loop, with a passive data
+    # connection per transfer. Error replies raise the ftplib exceptions,
+    # as FtpConnection does.
+    #
+    encoding = 'utf-8'
+    block_size = 8192
+    # Idle ones wait in the FTP connection pool for the asyncio core only
+    kind = 'asyncio'
+
+    def __init__(self, url):
+        self.url = url
+        self.last_reply = time.monotonic()
+        self.broken = False
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.url.hostname, self.url.port or 21), Config.ftp_timeout)
+        await self._get_response()
+        user = self.url.username or 'anonymous'
+        password = self.url.password or ''
+        if user == 'anonymous' and password in ('', '-'):
+            password += 'anonymous@'
+        if (await self.command('USER ' + user))[0] == '3':
+            await self.command('PASS ' + password)
+        await self.command('TYPE I')
+
+    def is_alive(self):
+        # What the pool checks from any thread, the NOOP is left to probe
+        return not self.broken
+
+    async def probe(self):
+        if self.broken:
+            return False
+        if time.monotonic() - self.last_reply < Config.ftp_idle_probe:
+            return True
+        # Any error reply, such as 421 before the server hangs up, means dead
+        try:
+            await self.command('NOOP')
+        except (error_reply, error_temp, error_perm, error_proto, OSError, EOFError, asyncio.TimeoutError):
+            self.broken = True
+        return not self.broken
+
+    async def command(self, line):
+        try:
+            self._writer.write((line + '\r\n').encode(self.encoding))
+            await self._writer.drain()
+        except OSError:
+            self.broken = True
+            raise
+        return await self._get_response()
+
+    async def size(self, path):
+        response = await self.command('SIZE ' + path)
+        if response[:3] == '213':
+            return int(response[3:].strip())
+
+    async def list_files(self, path):
+        reader, writer = await self._open_data('LIST ' + path)
+        try:
+            data = await asyncio.wait_for(reader.read(), Config.ftp_timeout)
+        finally:
+            writer.close()
+        await self._void_response()
+        return ftpparser.FTPParser().parse(data.decode(self.encoding).splitlines())
+
+    async def retrieve(self, path, write, progress=None, paused=None):
+        loop = asyncio.get_event_loop()
+        reader, writer = await self._open_data('RETR ' + path)
+        try:
+            while True:
+                await self._wait_unpaused(paused)
+                data = await asyncio.wait_for(reader.read(self.block_size), Config.ftp_timeout)
+                if not data:
+                    break
+                # Local disks can be slow too, the loop serves all hosts
+                await loop.run_in_executor(None, write, data)
+                if progress:
+                    progress(len(data))
+        finally:
+            writer.close()
+        await self._void_response()
+
+    async def store(self, path, file, progress=None, paused=None):
+        loop = asyncio.get_event_loop()
+        reader, writer = await self._open_data('STOR ' + path)
+        try:
+            while True:
+                await self._wait_unpaused(paused)
+                data = await loop.run_in_executor(None, file.read, self.block_size)
+                if not data:
+                    break
+                writer.write(data)
+                await asyncio.wait_for(writer.drain(), Config.ftp_timeout)
+                if progress:
+                    progress(len(data))
+        finally:
+            writer.close()
+        await self._void_response()
+
+    def close(self):
+        self.broken = True
+        if self._writer is not None:
+            self._writer.close()
+
+    def quit(self):
+        # How the pool closes connections, from any thread
+        self.broken = True
+        NetworkLoop.call_soon(self.close)
+
+    async def _open_data(self, line):
+        # Passive mode; like ftplib, the PASV address is not trusted over the control peer's
+        peer = self._writer.get_extra_info('peername')[0]
+        if self._writer.get_extra_info('socket').family == socket.AF_INET:
+            _, port = parse227(await self.command('PASV'))
+        else:
+            _, port = parse229(await self.command('EPSV'), peer)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(peer, port), Config.ftp_timeout)
+        try:
+            response = await self.command(line)
+            if response[0] == '2':
+                response = await self._get_response()
+            if response[0] != '1':
+                raise error_reply(response)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _void_response(self):
+        response = await self._get_response()
+        if response[0] != '2':
+            raise error_reply(response)
+
+    async def _get_response(self):
+        try:
+            response = await self._get_line()
+            if response[3:4] == '-':
+                code = response[:3]
+                while True:
+                    line = await self._get_line()
+                    response += '\n' + line
+                    if line[:3] == code and line[3:4] != '-':
+                        break
+        except (OSError, EOFError, asyncio.TimeoutError):
+            self.broken = True
+            raise
+        self.last_reply = time.monotonic()
+        if response[0] in '123':
+            return response
+        if response[0] == '4':
+            raise error_temp(response)
+        if response[0] == '5':
+            raise error_perm(response)
+        raise error_proto(response)
+
+    async def _get_line(self):
+        line = await asyncio.wait_for(self._reader.readline(), Config.ftp_timeout)
+        if not line:
+            raise EOFError
+        return line.decode(self.encoding).rstrip('\r\n')
+
+    @staticmethod
+    async def _wait_unpaused(paused):
+        while paused and paused():
+            await asyncio.sleep(0.2)
+
+
+class AsyncFtp():
+    #
+    # Loop driven FTP connections. They are counted and kept idle by the
+    # FTP connection pool, so they share Config.max_connections_per_host
+    # with the threaded connections of the host. Waiting for room in the
+    # pool blocks, it happens on threads of its own.
+    #
+    _waiting = concurrent.futures.ThreadPoolExecutor()
+
+    @staticmethod
+    def list_files(url):
+        url = urlparse(url)
+        return NetworkLoop.submit(AsyncFtp._call(url, lambda ftp: ftp.list_files(url.path)))
+
+    @staticmethod
+    def size(url):
+        url = urlparse(url)
+        return NetworkLoop.submit(AsyncFtp._call(url, lambda ftp: ftp.size(url.path)))
+
+    @staticmethod
+    def retrieve(url, write, progress=None, paused=None):
+        # write runs on an executor thread, progress on the loop thread and must not block
+        url = urlparse(url)
+        return NetworkLoop.submit(AsyncFtp._call(url, lambda ftp: ftp.retrieve(url.path, write, progress, paused)))
+
+    @staticmethod
+    def store(url, file, progress=None, paused=None):
+        url = urlparse(url)
+        return NetworkLoop.submit(AsyncFtp._call(url, lambda ftp: ftp.store(url.path, file, progress, paused)))
+
+    @staticmethod
+    async def _call(url, operation):
+        host = url.hostname
+        connection = await AsyncFtp._take(url)
+        try:
+            result = await operation(connection)
+        except (error_perm, error_temp):
+            # The server refused, the connection is fine
+            FtpBackgroundWrapper._pool.put(host, connection, reuse=True)
+            raise
+        except BaseException:
+            # Canceled or failed half way, the state of the connection is unknown
+            FtpBackgroundWrapper._pool.put(host, connection, reuse=False)
+            raise
+        FtpBackgroundWrapper._pool.put(host, connection, reuse=True)
+        return result
+
+    @staticmethod
+    async def _take(url):
+        pool = FtpBackgroundWrapper._pool
+        while True:
+            connection = await AsyncFtp._wait_for_room(url.hostname)
+            if connection is None:
+                break
+            if await connection.probe():
+                return connection
+            pool.put(url.hostname, connection, reuse=False)
+        connection = AsyncFtpConnection(url)
+        try:
+            await connection.connect()
+        except BaseException:
+            connection.close()
+            pool.forget(url.hostname)
+            raise
+        return connection
+
+    @staticmethod
+    async def _wait_for_room(host):
+        # An idle loop driven connection, or None once room for a new one is counted
+        waiting = AsyncFtp._waiting.submit(FtpBackgroundWrapper._pool.take, host, AsyncFtpConnection.kind)
+        try:
+            return await asyncio.wrap_future(waiting)
+        except asyncio.CancelledError:
+            # What the pool hands out after the cancel goes back to it
+            waiting.add_done_callback(partial(AsyncFtp._give_back, host))
+            raise
+
+    @staticmethod
+    def _give_back(host, waiting):
+        if waiting.cancelled() or waiting.exception() is not None:
+            return
+        connection = waiting.result()
+        if connection is None:
+            FtpBackgroundWrapper._pool.forget(host)
+        else:
+            FtpBackgroundWrapper._pool.put(host, connection, reuse=True)
@@ -1,39 +1,76 @@
+from os import stat
 from os.path import basename as path_basename, dirname as path_dirname
+from threading import Lock
 
 
 class Cache():
+    #
+    # Values per attribute, directory and file name. Directories are
+    # spread over shards with a lock each, so listings of different
+    # directories from different threads never wait for each other.
+    #
+
     @classmethod
     def put(cls, path, attr, value):
-        cls._cache.setdefault(attr, {}).setdefault(path_dirname(path), {})[path_basename(path)] = value
+        lock, entries = cls._shard(path_dirname(path))
+        with lock:
+            entries.setdefault((attr, path_dirname(path)), {})[path_basename(path)] = value
 
     @classmethod
     def get(cls,path, attr, default=None):
-        try:
-            return cls._cache[attr][path_dirname(path)][path_basename(path)]
-        except KeyError:
-            return default
+        lock, entries = cls._shard(path_dirname(path))
+        with lock:
+            return entries.get((attr, path_dirname(path)), {}).get(path_basename(path), default)
 
     @classmethod
     def clear(cls,path, attr, only_content=False):
-        try:
-            if only_content:
-                cls._cache[attr][path] = {}
-            else:
-                del cls._cache[attr][path_dirname(path)][path_basename(path)]
-        except KeyError:
-            pass
+        if only_content:
+            lock, entries = cls._shard(path)
+            with lock:
+                entries[(attr, path)] = {}
+        else:
+            cls.pop(path, attr)
 
     @classmethod
     def pop(cls,path, attr, default=None):
-        try:
-            return cls._cache[attr][path_dirname(path)].pop(path_basename(path), default)
-        except KeyError:
-            return default
+        lock, entries = cls._shard(path_dirname(path))
+        with lock:
+            return entries.get((attr, path_dirname(path)), {}).pop(path_basename(path), default)
+
+    @classmethod
+    def _shard(cls, directory):
+        return cls._shards[hash(directory) % len(cls._shards)]
+
+
+def _make_shards(count=16):
+    return [(Lock(), {}) for _ in range(count)]
 
 
 class SftpCache(Cache):
-    _cache = {}
+    _shards = _make_shards()
 
 
 class FtpCache(Cache):
+    _shards = _make_shards()
+
+
+class FileCache():
+    # Values parsed from local files, loaded again once the file changes
     _cache = {}
+    _lock = Lock()
+
+    @classmethod
+    def load(cls, path, loader):
+        try:
+            file_stat = stat(path)
+            stamp = file_stat.st_mtime_ns, file_stat.st_size
+        except OSError:
+            stamp = None
+        with cls._lock:
+            entry = cls._cache.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        value = loader(path)
+        with cls._lock:
+            cls._cache[path] = (stamp, value)
+        return value
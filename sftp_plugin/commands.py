@@ -1,20 +1,28 @@
 import json
 import platform
+import posixpath
 from subprocess import call
 from tempfile import NamedTemporaryFile
+from threading import Lock, Timer
 from urllib.parse import urlparse
 
 from fman import (NO, YES, ApplicationCommand, DirectoryPaneCommand,
                   DirectoryPaneListener, QuicksearchItem, show_alert,
-                  show_quicksearch, show_status_message, submit_task)
+                  show_prompt, show_quicksearch, show_status_message,
+                  submit_task)
 from fman.fs import exists, is_dir
+from fman.url import dirname as url_dirname
 from fman.url import join as url_join
 from fman.url import splitscheme
 
+from .aio import AsyncSftp
 from .config import Config, is_ftp, is_sftp
-from .filesystems import FtpCopyFileTask, SftpCopyFileTask
-from .ftp import FtpWrapper
-from .sftp import SftpWrapper
+from .connections import ConnectionPool
+from .filesystems import FtpCopyFileTask, SftpCopyFileTask, SftpDirSizeTask
+from .ftp import FtpBackgroundWrapper, FtpWrapper
+from .metrics import TransferMetrics, format_size
+from .sftp import (INTERACTIVE, SftpBackgroundWrapper, SftpPrewarm, SftpWrapper,
+                   sftp_find, sftp_grep)
 
 
 class OpenSftp(DirectoryPaneCommand):
@@ -41,13 +49,13 @@ class EditSftpFile(DirectoryPaneCommand):
         if url and exists(url) and not is_dir(url):
             with NamedTemporaryFile(delete=True) as tmp_file:
                 local_file_url = 'file://' + tmp_file.name
-                submit_task(SftpCopyFileTask(url, local_file_url))
+                submit_task(SftpCopyFileTask(url, local_file_url, priority=INTERACTIVE))
                 
                 self.pane.run_command('open_with_editor', args={'url': local_file_url})
                 
                 choice = show_alert('Would you like to upload edited file?', buttons=YES | NO, default_button=YES)
                 if choice == YES:
-                    submit_task(SftpCopyFileTask(local_file_url, url))
+                    submit_task(SftpCopyFileTask(local_file_url, url, priority=INTERACTIVE))
 
 
 class EditFtpFile(DirectoryPaneCommand):
@@ -60,13 +68,142 @@ class EditFtpFile(DirectoryPaneCommand):
         if url and exists(url) and not is_dir(url):
             with NamedTemporaryFile(delete=True) as tmp_file:
                 local_file_url = 'file://' + tmp_file.name
-                submit_task(FtpCopyFileTask(url, local_file_url))
+                submit_task(FtpCopyFileTask(url, local_file_url, priority=INTERACTIVE))
                 
                 self.pane.run_command('open_with_editor', args={'url': local_file_url})
                 
                 choice = show_alert('Would you like to upload edited file?', buttons=YES | NO, default_button=YES)
                 if choice == YES:
-                    submit_task(FtpCopyFileTask(local_file_url, url))
+                    submit_task(FtpCopyFileTask(local_file_url, url, priority=INTERACTIVE))
+
+
+class CalculateSftpSize(DirectoryPaneCommand):
+    aliases = ('Calculate directory size',)
+
+    def is_visible(self):
+        return is_sftp(self.pane.get_path())
+
+    def __call__(self, urls=None):
+        if not urls:
+            urls = self.get_chosen_files()
+        urls = [url for url in urls if is_sftp(url) and is_dir(url)]
+        if not urls:
+            show_status_message('No remote directory selected.')
+            return
+        submit_task(SftpDirSizeTask(urls))
+
+
+class SearchSftp(DirectoryPaneCommand):
+    aliases = ('Search remote files',)
+    prompt = 'Search files (e.g. *.log size:+1M mtime:-7)'
+    default_query = '*'
+
+    def is_visible(self):
+        return is_sftp(self.pane.get_path())
+
+    def __call__(self, url=None):
+        if not url:
+            url = self.pane.get_path()
+        if not is_sftp(url) or not splitscheme(url)[1]:
+            show_status_message('No remote directory opened.')
+            return
+        query, ok = show_prompt(self.prompt, default=self.default_query)
+        if not ok or not query:
+            return
+        with SftpBackgroundWrapper(url, priority=INTERACTIVE) as sftp:
+            self._host, self._root = sftp.host, sftp.path
+            try:
+                self._results = StreamedResults(self._search(sftp.conn, query))
+            except OSError as e:
+                show_alert(str(e))
+                return
+            result = show_quicksearch(self._get_items)
+        if result:
+            _, value = result
+            self.pane.set_path(url_dirname(value), callback=lambda: self.pane.place_cursor_at(value))
+
+    def _search(self, conn, query):
+        return sftp_find(conn, self._root, **self._parse_filters(query))
+
+    def _parse_filters(self, query):
+        filters = {}
+        for token in query.split():
+            key, _, value = token.rpartition(':')
+            if key in ('size', 'mtime', 'name'):
+                filters[key] = value
+            elif not any(char in token for char in '*?['):
+                filters['name'] = '*' + token + '*'
+            else:
+                filters['name'] = token
+        return filters
+
+    def _get_items(self, query):
+        for result in self._results:
+            remote_path, title, description = self._describe(result)
+            try:
+                index = title.lower().index(query)
+            except ValueError:
+                continue
+            else:
+                # The characters that should be highlighted:
+                highlight = range(index, index + len(query))
+                url = Config.sftp_scheme + self._host + remote_path
+                yield QuicksearchItem(url, title=title, highlight=highlight, hint=self._host, description=description)
+
+    def _describe(self, remote_path):
+        return remote_path, posixpath.relpath(remote_path, self._root), None
+
+
+class GrepSftp(SearchSftp):
+    aliases = ('Grep in remote directory',)
+    prompt = 'Search text in remote files'
+    default_query = ''
+    files_only = False
+
+    def _search(self, conn, query):
+        return sftp_grep(conn, self._root, query, files_only=self.files_only)
+
+    def _describe(self, result):
+        remote_path, line_number, text = result
+        title = posixpath.relpath(remote_path, self._root)
+        if line_number:
+            title += ':' + line_number
+        return remote_path, title, text
+
+
+class GrepSftpFiles(GrepSftp):
+    aliases = ('Grep in remote directory (file names only)',)
+    files_only = True
+
+
+class StreamedResults():
+    # Shares one lazily consumed source between successive quicksearch queries
+    def __init__(self, source):
+        self._source = iter(source)
+        self._results = []
+        self._lock = Lock()
+        self._done = False
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._lock:
+                if index == len(self._results):
+                    if self._done:
+                        return
+                    try:
+                        self._results.append(next(self._source))
+                    except StopIteration:
+                        self._done = True
+                        return
+                    except OSError as e:
+                        # A search that failed part way keeps what it found so far
+                        self._done = True
+                        show_status_message(str(e))
+                        return
+                result = self._results[index]
+            index += 1
+            yield result
 
 
 class OpenNetwork(DirectoryPaneCommand):
@@ -89,6 +226,7 @@ class CloseNetwork(ApplicationCommand):
                 _, path = splitscheme(value)
                 if is_sftp(value):
                     SftpWrapper.close_connection(path)    
+                    AsyncSftp.close_host(path)
                 elif is_ftp(value):
                     FtpWrapper.close_connection(path)
                 show_status_message('Connection '+path+' closed.')
@@ -126,10 +264,85 @@ class CloseNetwork(ApplicationCommand):
                 pane.set_path(current_scheme)
 
 
+class ShowTransferDashboard(ApplicationCommand):
+    aliases = ('Show transfer dashboard',)
+
+    def __call__(self):
+        result = show_quicksearch(self._get_items)
+        if result and result[1].startswith('transfer:'):
+            transfer = TransferMetrics.get_transfer(int(result[1].split(':', 1)[1]))
+            if transfer:
+                self._control(transfer)
+
+    def _control(self, transfer):
+        actions = [('Cancel', transfer.cancel),
+                   ('Resume' if transfer.paused else 'Pause', lambda: setattr(transfer, 'paused', not transfer.paused))]
+        if transfer.state == 'queued':
+            actions.append(('Move to front', lambda: TransferMetrics.move_to_front(transfer)))
+            actions.append(('Move to back', lambda: TransferMetrics.move_to_back(transfer)))
+        result = show_quicksearch(lambda query: (
+            QuicksearchItem(title, title=title, hint=transfer.title)
+            for title, _ in actions if query.lower() in title.lower()))
+        if result:
+            dict(actions)[result[1]]()
+            show_status_message('%s: %s' % (transfer.title, result[1]))
+
+    def _get_items(self, query):
+        query = query.lower()
+        for transfer in TransferMetrics.get_transfers('active') + TransferMetrics.get_transfers('queued'):
+            title = '%s (%s)' % (transfer.title, transfer.host)
+            if query in title.lower():
+                yield QuicksearchItem('transfer:%d' % transfer.id, title=title,
+                                      hint=transfer.state, description=transfer.describe())
+        for scheme, hosts, background in (
+                (Config.sftp_scheme, SftpWrapper.get_all_active_connections(), SftpBackgroundWrapper.get_connection_counts()),
+                (Config.ftp_scheme, FtpWrapper.get_all_active_connections(), FtpBackgroundWrapper.get_connection_counts())):
+            for host in sorted(set(hosts) | set(background), key=str):
+                title = url_join(scheme, str(host))
+                if query in title.lower():
+                    count = (host in hosts) + background.get(host, 0)
+                    yield QuicksearchItem('connection:' + title, title=title,
+                                          hint='%d connections' % count,
+                                          description='%d background' % background.get(host, 0))
+
+
+class ShowTransferStatistics(ApplicationCommand):
+    aliases = ('Show transfer statistics',)
+
+    def __call__(self):
+        lines = [TransferMetrics.get_summary(), '']
+        for host, stats in sorted(TransferMetrics.get_host_stats().items(), key=lambda item: str(item[0])):
+            lines.append('%s: %s transferred, %s/s, %d active, %d queued' % (
+                host, format_size(stats['bytes']), format_size(stats['rate']), stats['active'], stats['queued']))
+        for host, ratio in sorted(SftpWrapper.get_compression_ratios().items()):
+            lines.append('%s: compression ratio %.1f:1' % (host, ratio))
+        for transfer in TransferMetrics.get_transfers():
+            lines.append('%s (%s): %s' % (transfer.title, transfer.state, transfer.describe()))
+        show_alert('\n'.join(lines))
+
+
 class NetworkListener(DirectoryPaneListener):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._warm_timer = None
+        self._warm_lock = Lock()
+        SftpPrewarm.start()
+
+    def on_path_changed(self):
+        # Hosts are connected in the background while the user picks one
+        url = self.pane.get_path()
+        ConnectionPool.set_shown(id(self.pane), self._get_host(url))
+        if url in (Config.sftp_scheme, Config.network_scheme):
+            SftpPrewarm.warm_recent()
+        if url == Config.sftp_scheme:
+            self._warm_host_under_cursor()
+
     def on_command(self, command_name, args):
         # show_alert('command '+ command_name)
         # show_alert('args '+ json.dumps(args))
+        if command_name.startswith('move_cursor') and self.pane.get_path() == Config.sftp_scheme:
+            # Called before the cursor moves, the host is read once it came to rest
+            self._schedule_warm()
         if command_name == 'open_directory':
             url = args.get('url', self.pane.get_path())
             if url == url_join(Config.network_scheme, 'ftp') :
@@ -173,6 +386,29 @@ class NetworkListener(DirectoryPaneListener):
                 new_args['url'] = url
                 return 'open_ssh_terminal', new_args
 
+    @staticmethod
+    def _get_host(url):
+        if is_sftp(url):
+            return SftpWrapper.parse_path(splitscheme(url)[1])[0]
+        if is_ftp(url):
+            return urlparse(url).hostname
+        return None
+
+    def _schedule_warm(self):
+        with self._warm_lock:
+            if self._warm_timer is not None:
+                self._warm_timer.cancel()
+            self._warm_timer = Timer(Config.sftp_prewarm_delay, self._warm_host_under_cursor)
+            self._warm_timer.daemon = True
+            self._warm_timer.start()
+
+    def _warm_host_under_cursor(self):
+        if self.pane.get_path() != Config.sftp_scheme:
+            return
+        url = self.pane.get_file_under_cursor()
+        if url and is_sftp(url):
+            SftpPrewarm.warm_host(splitscheme(url)[1].split('/')[0])
+
 
 class OpenSshTerminal(DirectoryPaneCommand):
     def is_visible(self):
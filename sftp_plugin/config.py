@@ -8,7 +8,40 @@ class Config():
     sftp_file = expanduser('~/.ssh/config')
     ftp_scheme = 'ftp://'
     ftp_file = 'FTP History.json'
+    sftp_tuning_file = 'SFTP Tuning.json'
+    sftp_history_file = 'SFTP Recent Hosts.json'
     network_scheme = 'network://'
+    sftp_pipeline_depth = 64
+    sftp_open_ahead = 8
+    sftp_chunk_size = 32768
+    sftp_tar_min_files = 32
+    sftp_tar_average_size = 64 * 1024
+    max_transfers_per_host = 2
+    sftp_bulk_connections = 2
+    max_connections_per_host = 4
+    max_connected_hosts = 8
+    connection_idle_timeout = 300
+    connection_reap_interval = 30
+    sftp_keepalive_interval = 30
+    sftp_timeout = 60
+    sftp_exec_timeout = 10
+    sftp_health_interval = 15
+    sftp_retries = 3
+    sftp_retry_delay = 0.5
+    sftp_prewarm_hosts = 3
+    sftp_prewarm_delay = 0.3
+    sftp_history_size = 10
+    ftp_idle_probe = 15
+    ftp_keepalive_interval = 60
+    ftp_timeout = 60
+    network_core = 'threads'
+    compressed_extensions = (
+        '.7z', '.apk', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg',
+        '.lz4', '.lzma', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.odt', '.ogg', '.png', '.pptx', '.rar',
+        '.tbz2', '.tgz', '.txz', '.webm', '.webp', '.whl', '.xlsx', '.xz', '.zip', '.zst')
+
+def is_compressible(path):
+    return not path.lower().endswith(Config.compressed_extensions)
 
 def is_file(url):
     try:
@@ -0,0 +1,276 @@
+import time
+from itertools import count
+from threading import Condition, Lock, Thread, local
+
+from .config import Config
+
+
+class HostRegistry():
+    #
+    # Host -> value map shared by the UI thread and task threads. Hosts are
+    # spread over shards with a lock each, compound updates are single
+    # calls and iteration works on a snapshot.
+    #
+    _missing = object()
+
+    def __init__(self, shard_count=16):
+        self._shards = [(Lock(), {}) for _ in range(shard_count)]
+
+    def __contains__(self, host):
+        return self.get(host, HostRegistry._missing) is not HostRegistry._missing
+
+    def __getitem__(self, host):
+        value = self.get(host, HostRegistry._missing)
+        if value is HostRegistry._missing:
+            raise KeyError(host)
+        return value
+
+    def __setitem__(self, host, value):
+        lock, entries = self._shard(host)
+        with lock:
+            entries[host] = value
+
+    def __delitem__(self, host):
+        if self.pop(host, HostRegistry._missing) is HostRegistry._missing:
+            raise KeyError(host)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._shards)
+
+    def get(self, host, default=None):
+        lock, entries = self._shard(host)
+        with lock:
+            return entries.get(host, default)
+
+    def pop(self, host, default=None):
+        lock, entries = self._shard(host)
+        with lock:
+            return entries.pop(host, default)
+
+    def replace(self, host, old, new):
+        # Stores new only while the host still maps to old (None: no entry), True if it did
+        lock, entries = self._shard(host)
+        with lock:
+            if entries.get(host) is not old:
+                return False
+            entries[host] = new
+            return True
+
+    def remove(self, host, old):
+        # Drops the host only while it still maps to old, True if it did
+        lock, entries = self._shard(host)
+        with lock:
+            if entries.get(host) is not old:
+                return False
+            del entries[host]
+            return True
+
+    def keys(self):
+        return [host for host, _ in self.items()]
+
+    def items(self):
+        items = []
+        for lock, entries in self._shards:
+            with lock:
+                items += entries.items()
+        return items
+
+    def _shard(self, host):
+        return self._shards[hash(host) % len(self._shards)]
+
+
+class ConnectionPool():
+    #
+    # The connections of one protocol, per host. At most
+    # Config.max_connections_per_host are open at a time, the foreground
+    # connection included; waiters are served in (priority, arrival)
+    # order and idle connections are handed out again. A reaper closes
+    # connections idle for Config.connection_idle_timeout and, beyond
+    # Config.max_connected_hosts, the idle ones of the least recently used
+    # hosts. Hosts unused for as long are disconnected, unless a pane
+    # shows them.
+    #
+    _pools = []
+    _reaper = None
+    _reaper_lock = Lock()
+    # Pane -> the host it shows
+    _shown = HostRegistry()
+
+    def __init__(self, close, is_alive, kind_of, foreground, close_host):
+        self._close = close
+        self._is_alive = is_alive
+        self._kind_of = kind_of
+        # Host -> foreground connection, and how to close all of a host
+        self._foreground = foreground
+        self._close_host = close_host
+        self._idle = {}
+        self._counts = {}
+        self._last_used = {}
+        self._waiting = []
+        self._tickets = count()
+        self._lock = Condition()
+        self._held = local()
+        ConnectionPool._pools.append(self)
+
+    def acquire(self, host, connect, kind=None, priority=0, limit=None):
+        # limit caps this kind of work below the host maximum
+        held = self._held.__dict__.setdefault('hosts', {})
+        connection = self.take(host, kind, priority, limit, nested=held.get(host, 0) > 0)
+        if connection is None:
+            try:
+                connection = connect()
+            except BaseException:
+                self.forget(host)
+                raise
+        held[host] = held.get(host, 0) + 1
+        return connection
+
+    def release(self, host, connection, reuse):
+        held = self._held.__dict__.setdefault('hosts', {})
+        held[host] -= 1
+        self.put(host, connection, reuse)
+
+    def take(self, host, kind=None, priority=0, limit=None, nested=False):
+        # Waits for an idle connection of the kind, or returns None once room
+        # for a new one is counted: the caller opens it and hands it back with
+        # put, or gives the room back with forget. Unlike acquire, not tied to
+        # the calling thread.
+        ticket = (priority, next(self._tickets), host)
+        evicted = []
+        with self._lock:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    connection = self._take(ticket, kind, limit, nested, evicted)
+                    if connection is not False:
+                        break
+                    self._lock.wait(1)
+            finally:
+                self._waiting.remove(ticket)
+                self._lock.notify_all()
+        for old in evicted:
+            self._close(old)
+        self.touch(host)
+        return connection
+
+    def put(self, host, connection, reuse):
+        reuse = reuse and self._is_alive(connection)
+        with self._lock:
+            if reuse:
+                self._idle.setdefault(host, []).append((connection, time.monotonic()))
+            else:
+                self._add_count(host, -1)
+            self._lock.notify_all()
+        if not reuse:
+            self._close(connection)
+
+    def forget(self, host):
+        with self._lock:
+            self._add_count(host, -1)
+            self._lock.notify_all()
+
+    def touch(self, host):
+        self._last_used[host] = time.monotonic()
+        ConnectionPool._start_reaper()
+
+    def close_idle(self, host):
+        with self._lock:
+            connections = [connection for connection, _ in self._idle.pop(host, [])]
+            self._add_count(host, -len(connections))
+            self._lock.notify_all()
+        for connection in connections:
+            self._close(connection)
+
+    @staticmethod
+    def set_shown(pane, host):
+        if host:
+            ConnectionPool._shown[pane] = host
+        else:
+            ConnectionPool._shown.pop(pane, None)
+
+    def get_counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reap(self):
+        now = time.monotonic()
+        timeout = Config.connection_idle_timeout
+        closing = []
+        with self._lock:
+            for host, idle in self._idle.items():
+                for entry in list(idle):
+                    if now - entry[1] >= timeout:
+                        idle.remove(entry)
+                        self._add_count(host, -1)
+                        closing.append(entry[0])
+            hosts = set(self._foreground) | set(self._counts)
+            recent = sorted(hosts, key=lambda host: self._last_used.get(host, 0), reverse=True)
+            evicted = recent[Config.max_connected_hosts:]
+            for host in evicted:
+                connections = [connection for connection, _ in self._idle.pop(host, [])]
+                self._add_count(host, -len(connections))
+                closing += connections
+            # Hosts with background work still running or open in a pane are left alone
+            shown = set(host for _, host in ConnectionPool._shown.items())
+            unused = [host for host in hosts if host not in self._counts and host not in shown and
+                      now - self._last_used.get(host, 0) >= timeout]
+            self._lock.notify_all()
+        for connection in closing:
+            self._close(connection)
+        for host in unused:
+            self._close_host(host)
+
+    def _take(self, ticket, kind, limit, nested, evicted):
+        # An idle connection, None to open a new one or False to keep waiting
+        priority, _, host = ticket
+        first = min(waiting for waiting in self._waiting if waiting[2] == host)
+        if ticket != first and not nested:
+            return False
+        idle = self._idle.get(host, [])
+        for entry in list(reversed(idle)):
+            connection, _ = entry
+            if not self._is_alive(connection):
+                idle.remove(entry)
+                self._add_count(host, -1)
+            elif self._kind_of(connection) == kind:
+                idle.remove(entry)
+                return connection
+        busy = self._counts.get(host, 0)
+        below_limit = limit is None or busy - len(idle) < limit
+        if not below_limit and not nested:
+            return False
+        # A thread already holding a connection would deadlock waiting for another
+        if nested or busy + (host in self._foreground) < Config.max_connections_per_host:
+            self._add_count(host, 1)
+            return None
+        if idle:
+            # The oldest idle connection of another kind makes room
+            connection, _ = idle.pop(0)
+            evicted.append(connection)
+            return None
+        return False
+
+    def _add_count(self, host, count):
+        self._counts[host] = self._counts.get(host, 0) + count
+        if not self._counts[host]:
+            del self._counts[host]
+
+    @staticmethod
+    def _start_reaper():
+        with ConnectionPool._reaper_lock:
+            if ConnectionPool._reaper is None:
+                ConnectionPool._reaper = Thread(target=ConnectionPool._reap_all, daemon=True)
+                ConnectionPool._reaper.start()
+
+    @staticmethod
+    def _reap_all():
+        while True:
+            time.sleep(Config.connection_reap_interval)
+            for pool in list(ConnectionPool._pools):
+                try:
+                    pool.reap()
+                except Exception:
+                    pass
@@ -1,23 +1,34 @@
 import errno
+import posixpath
 import stat
+import tarfile
+from concurrent.futures import Future, TimeoutError
+from contextlib import closing
 from datetime import datetime
 from io import UnsupportedOperation
+from os import sep, walk
 from os.path import basename as path_basename
 from os.path import getsize
 from os.path import join as path_join
+from os.path import realpath, relpath
 from tempfile import NamedTemporaryFile
 
 from fman import Task, fs, show_alert, show_status_message, submit_task
 from fman.fs import (FileSystem, cached, notify_file_added,
-                     notify_file_changed, touch)
+                     notify_file_changed)
 from fman.url import basename as url_basename
 from fman.url import join as url_join
 from fman.url import splitscheme
 
+from .aio import AsyncFtp, AsyncSftp, NetworkLoop
 from .cache import FtpCache, SftpCache
-from .config import Config, is_file, is_ftp, is_sftp
+from .config import Config, is_compressible, is_file, is_ftp, is_sftp
 from .ftp import FtpBackgroundWrapper, FtpConfig, FtpWrapper
-from .sftp import SftpBackgroundWrapper, SftpConfig, SftpWrapper
+from .metrics import Transfer, TransferMetrics
+from .sftp import (BULK, INTERACTIVE, SftpBackgroundWrapper, SftpBatch, SftpConfig,
+                   SftpWrapper, paramiko, sftp_command, sftp_exec, sftp_exec_channel,
+                   sftp_exit_status, sftp_retry, sftp_walk)
+from .transfer import resumable_transfer
 
 
 class SftpFileSystem(FileSystem):
@@ -31,6 +42,8 @@ class SftpFileSystem(FileSystem):
 
     @cached
     def size_bytes(self, path):
+        if self.is_dir(path):
+            return SftpCache.get(path, 'dir_size')
         try:
             return self.cache.get(path, 'size_bytes')
         except KeyError:
@@ -73,7 +86,11 @@ class SftpFileSystem(FileSystem):
             else:
                 with SftpWrapper(self.scheme + path) as sftp:
                     SftpCache.clear(path, 'is_dir', only_content=True)
-                    for file_attributes in sftp.conn.listdir_attr(sftp.path):
+                    if NetworkLoop.is_enabled():
+                        listing = NetworkLoop.result(AsyncSftp.listdir_attr(sftp.host, sftp.path), Config.sftp_timeout)
+                    else:
+                        listing = sftp_retry(sftp, lambda conn: conn.listdir_attr(sftp.path))
+                    for file_attributes in listing:
                         self.save_stats(
                             path_join(path, file_attributes.filename), file_attributes)
                         yield file_attributes.filename
@@ -116,7 +133,134 @@ class SftpFileSystem(FileSystem):
         if is_sftp(dst_url) and not self._is_server_path(dst_path):
             show_status_message('Destination path invalid.')
             return []
-        return self._prepare_copy(src_url, dst_url)
+        if (is_sftp(src_url) and self.is_dir(splitscheme(src_url)[1])) or (is_file(src_url) and fs.is_dir(src_url)):
+            return [CopyTreeTask(src_url, dst_url, lambda: self._plan_copy(src_url, dst_url))]
+        return self._plan_copy(src_url, dst_url)
+
+    def _plan_copy(self, src_url, dst_url):
+        if is_file(src_url) and is_sftp(dst_url) and fs.is_dir(src_url):
+            return self._prepare_upload_tree(src_url, dst_url)
+        if is_sftp(src_url) and is_file(dst_url) and self.is_dir(splitscheme(src_url)[1]):
+            return self._prepare_download_tree(src_url, dst_url)
+        return self._stat_missing_sizes(list(self._prepare_copy(src_url, dst_url)))
+
+    def _stat_missing_sizes(self, tasks):
+        # Sizes not in the listing cache are fetched in one batch per host
+        missing = {}
+        for task in tasks:
+            if isinstance(task, SftpCopyFileTask) and not task.size_known and is_sftp(task.src_url):
+                missing.setdefault(SftpWrapper(task.src_url).host, []).append(task)
+        batches = []
+        for host_tasks in missing.values():
+            with SftpWrapper(host_tasks[0].src_url) as sftp:
+                paths = [splitscheme(task.src_url)[1] for task in host_tasks]
+                if NetworkLoop.is_enabled():
+                    # The stats of all hosts are in flight at once
+                    results = AsyncSftp.stat_all(sftp.host, [SftpWrapper.parse_path(path)[1] for path in paths])
+                else:
+                    results = [result for _, result in sftp_retry(sftp, self._run_batch, 'stat', paths)]
+                batches.append((host_tasks, paths, results))
+        for host_tasks, paths, results in batches:
+            if isinstance(results, Future):
+                results = NetworkLoop.result(results, Config.sftp_timeout)
+            for task, path, result in zip(host_tasks, paths, results):
+                if not isinstance(result, Exception):
+                    SftpCache.put(path, 'size', result.st_size)
+                    task.set_size(result.st_size)
+        return tasks
+
+    def _prepare_upload_tree(self, src_url, dst_url):
+        _, src_path = splitscheme(src_url)
+        _, dst_path = splitscheme(dst_url)
+        dirs_to_create = [dst_path]
+        files_to_copy = []
+        total_size = 0
+
+        # Plan the whole tree from the local walk, parents before children.
+        # Remote and relative paths use '/' on every platform.
+        for root, dir_names, file_names in walk_local(src_path):
+            rel_root = relpath(root, src_path).replace(sep, '/')
+            if rel_root == '.':
+                rel_root = ''
+            for dname in dir_names:
+                dirs_to_create.append(posixpath.join(dst_path, rel_root, dname))
+            for fname in file_names:
+                files_to_copy.append(posixpath.join(rel_root, fname))
+                total_size += getsize(path_join(root, fname))
+
+        def upload_files(done=()):
+            # What a failed tar stream left on the server is unknown, everything is copied
+            self._makedirs(dirs_to_create)
+            if files_to_copy:
+                yield SftpMultiCopyTask(src_url, dst_url, files_to_copy, total_size)
+
+        if self._use_tar(total_size, len(files_to_copy)):
+            yield SftpTarCopyTask(src_url, dst_url, total_size, len(files_to_copy), upload_files,
+                                  compressible=self._mostly_compressible(files_to_copy))
+        else:
+            yield from upload_files()
+
+    def _prepare_download_tree(self, src_url, dst_url):
+        _, src_path = splitscheme(src_url)
+        dirs_to_create = ['']
+        files_to_copy = []
+        sizes = {}
+
+        with SftpBackgroundWrapper(src_url) as sftp:
+            for dir_path, entries in sftp_walk(sftp.conn, sftp.path):
+                rel_root = posixpath.relpath(dir_path, sftp.path)
+                if rel_root == '.':
+                    rel_root = ''
+                for file_attributes in entries:
+                    rel_path = posixpath.join(rel_root, file_attributes.filename)
+                    self.save_stats(posixpath.join(src_path, rel_path), file_attributes)
+                    if stat.S_ISDIR(file_attributes.st_mode):
+                        dirs_to_create.append(rel_path)
+                    else:
+                        files_to_copy.append(rel_path)
+                        sizes[rel_path] = file_attributes.st_size
+        total_size = sum(sizes.values())
+
+        def download_files(done=()):
+            # done: the files a tar stream already brought
+            for dname in dirs_to_create:
+                fs.makedirs(url_join(dst_url, dname) if dname else dst_url, exist_ok=True)
+            remaining = [fname for fname in files_to_copy if fname not in done]
+            if remaining:
+                yield SftpMultiCopyTask(src_url, dst_url, remaining, sum(sizes[fname] for fname in remaining))
+
+        if self._use_tar(total_size, len(files_to_copy)):
+            yield SftpTarCopyTask(src_url, dst_url, total_size, len(files_to_copy), download_files,
+                                  compressible=self._mostly_compressible(files_to_copy))
+        else:
+            yield from download_files()
+
+    def _use_tar(self, total_size, file_count):
+        return file_count >= Config.sftp_tar_min_files and \
+            total_size / file_count < Config.sftp_tar_average_size
+
+    def _mostly_compressible(self, files):
+        return sum(map(is_compressible, files)) * 2 >= len(files)
+
+    def _makedirs(self, paths):
+        with SftpBackgroundWrapper(self.scheme + paths[0]) as sftp:
+            pending = paths
+            while pending:
+                failed = []
+                for path, result in self._run_batch(sftp.conn, 'mkdir', pending):
+                    if isinstance(result, Exception):
+                        failed.append(path)
+                    else:
+                        SftpCache.put(path, 'is_dir', True)
+                if len(failed) == len(pending):
+                    break
+                pending = failed
+            # Whatever still failed must already exist as a directory
+            for path, result in self._run_batch(sftp.conn, 'stat', pending):
+                if isinstance(result, Exception) or not stat.S_ISDIR(result.st_mode):
+                    raise OSError(errno.EEXIST, "Cannot create directory", path)
+                SftpCache.put(path, 'is_dir', True)
+        self.notify_file_added(paths[0])
 
     def _prepare_copy(self, src_url, dst_url):
         _, src_path = splitscheme(src_url)
@@ -182,29 +326,60 @@ class SftpFileSystem(FileSystem):
         return self._prepare_delete(path)
 
     def _prepare_delete(self, path):
+        files, dirs = [], []
+        self._collect_delete(path, files, dirs)
+        yield Task('Deleting ' + path_basename(path), fn=self._delete, args=(path, files, dirs))
+
+    def _collect_delete(self, path, files, dirs):
         if self.is_dir(path):
             for fname in self.iterdir(path):
-                yield from self._prepare_delete(path_join(path, fname))
-        yield Task('Deleting ' + path_basename(path), fn=self._delete, args=(path,))
-
-    def _delete(self, path):
-        with SftpWrapper(self.scheme + path) as sftp:
-            if self.is_dir(path):
-                sftp.conn.rmdir(sftp.path)
-                show_status_message('Directory deleted.')
+                self._collect_delete(path_join(path, fname), files, dirs)
+            dirs.append(path)
+        else:
+            files.append(path)
+
+    def _delete(self, path, files, dirs):
+        with SftpBackgroundWrapper(self.scheme + path) as sftp:
+            errors = self._remove_batch(sftp.conn, 'remove', files)
+            # Deepest directories first, retried while the server makes progress
+            pending = sorted(dirs, key=lambda dir_path: dir_path.count('/'), reverse=True)
+            while pending:
+                failed = self._remove_batch(sftp.conn, 'rmdir', pending)
+                if len(failed) == len(pending):
+                    errors.extend(failed)
+                    break
+                pending = [dir_path for dir_path, _ in failed]
+        if errors:
+            raise errors[0][1]
+        show_status_message('Directory deleted.' if dirs else 'File deleted.')
+
+    def _remove_batch(self, conn, operation, paths):
+        failed = []
+        for path, result in self._run_batch(conn, operation, paths):
+            if isinstance(result, Exception):
+                failed.append((path, result))
             else:
-                sftp.conn.remove(sftp.path)
-                show_status_message('File deleted.')
-        SftpCache.clear(path, 'is_dir')
-        self.notify_file_removed(path)
+                SftpCache.clear(path, 'is_dir')
+                self.notify_file_removed(path)
+        return failed
+
+    def _run_batch(self, conn, operation, paths):
+        batch = SftpBatch(conn)
+        for path in paths:
+            getattr(batch, operation)(SftpWrapper.parse_path(path)[1])
+        return list(zip(paths, batch.run()))
 
     def touch(self, path):
         if not self._is_server_path(path):
             raise OSError(errno.EADDRNOTAVAIL, "File path invalid")
         if self.exists(path):
             raise OSError(errno.EEXIST, "File exists")
-        with SftpWrapper(self.scheme + path) as sftp, NamedTemporaryFile(delete=True) as tmp_file:
-            sftp.conn.put(tmp_file.name, sftp.path)
+        with SftpWrapper(self.scheme + path) as sftp:
+            batch = SftpBatch(sftp.conn)
+            batch.touch(sftp.path)
+            result, = batch.run()
+        if isinstance(result, Exception):
+            raise result
         SftpCache.put(path, 'is_dir', False)
         self.notify_file_added(path)
         show_status_message('File added.')
@@ -226,6 +401,7 @@ class SftpFileSystem(FileSystem):
             group = file_attributes.st_gid
 
         SftpCache.put(path, 'is_dir', is_dir)
+        SftpCache.put(path, 'size', file_attributes.st_size)
         self.cache.put(path, 'size_bytes', file_attributes.st_size)
         self.cache.put(path, 'modified_datetime', dt_mtime)
         self.cache.put(path, 'get_permissions', st_mode)
@@ -233,46 +409,209 @@ class SftpFileSystem(FileSystem):
         self.cache.put(path, 'get_group', group)
 
 
-class SftpCopyFileTask(Task):
-    def __init__(self, src_url, dst_url):
-        super().__init__('Copying ' + url_basename(src_url))
-        self._src_url = src_url
-        self._dst_url = dst_url
-        self._set_size(src_url)
+class CopyTask(Task):
+    file_count = 1
+
+    def __init__(self, title, size=0, host=None, priority=BULK):
+        # Only listed once the task runs, a task fman never starts holds up no queue
+        self._transfer = Transfer(title, host, size, interactive=priority == INTERACTIVE)
+        super().__init__(title, size=size)
+        self._priority = priority
+        self._size_written = 0
+        self._parent = None
 
     def __call__(self):
-        if self.get_size() > 0:
-            self._copy(self._src_url, self._dst_url)
-        else:
-            touch(self._dst_url)
+        try:
+            if self._parent:
+                self._transfer.start()
+            else:
+                TransferMetrics.acquire(self._transfer)
+            self._run()
+        finally:
+            self._transfer.finish()
+            if not self._parent:
+                TransferMetrics.show_status(force=True)
+
+    def set_size(self, size):
+        super().set_size(size)
+        self._transfer.size = size
+
+    def attach(self, parent):
+        # Progress is reported to and measured by the parent from now on
+        self._parent = parent
+
+    def _add_progress(self, size):
+        self._size_written += size
+        if self._parent:
+            self._parent.add_progress(size)
+            return
+        self.set_progress(self._size_written)
+        if self._transfer.add(size):
+            self.set_text(self._describe())
+            TransferMetrics.show_status()
+        self._transfer.check()
+        self.check_canceled()
 
-    def _set_size(self, src_url):
+    def _file_done(self):
+        if self._parent:
+            self._parent.file_done()
+
+    def _take_back(self, size, files=0):
+        # Progress that the copies replacing it count again
+        self._size_written -= size
+        if self._parent:
+            self._parent.take_back(size, files)
+            return
+        self._transfer.take_back(size)
+        self.set_progress(self._size_written)
+
+    def _await_transfer(self, start):
+        # The transfer runs on the network loop; progress, pauses and
+        # cancels are handled on this thread
+        progress = []
+        future = start(progress.append, lambda: self._transfer.paused)
+        try:
+            while True:
+                try:
+                    return future.result(timeout=0.2)
+                except TimeoutError:
+                    pass
+                finally:
+                    while progress:
+                        self._add_progress(progress.pop(0))
+        except BaseException:
+            future.cancel()
+            raise
+
+    def _count_retry(self):
+        # Reconnects are shown on the transfer the user sees
+        if self._parent:
+            self._parent._count_retry()
+            return
+        self._transfer.retries += 1
+        self.set_text(self._describe())
+
+    def _describe(self):
+        return self._transfer.describe()
+
+
+class CopyTreeTask(CopyTask):
+    def __init__(self, src_url, dst_url, plan):
+        super().__init__('Copying ' + url_basename(src_url), host=remote_host(src_url, dst_url))
+        self._plan = plan
+        self._files_done = 0
+        self.file_count = 0
+
+    def _run(self):
+        self.set_text('Preparing...')
+        tasks = list(self._plan())
+        self.file_count = sum(task.file_count for task in tasks)
+        self.set_size(sum(task.get_size() for task in tasks))
+        for task in tasks:
+            task.attach(self)
+        for task in tasks:
+            task()
+        self.set_text(self._describe())
+
+    def add_progress(self, size):
+        self._add_progress(size)
+
+    def file_done(self):
+        self._files_done += 1
+
+    def take_back(self, size, files):
+        self._files_done -= files
+        self._take_back(size)
+
+    def _describe(self):
+        return '%d of %d files, %s' % (self._files_done, self.file_count, self._transfer.describe())
+
+
+def walk_local(path):
+    # os.walk into symlinked directories too, but not into links back to
+    # the directory itself or one above it
+    for root, dir_names, file_names in walk(path, followlinks=True):
+        real_root = path_join(realpath(root), '')
+        dir_names[:] = [name for name in dir_names
+                        if not real_root.startswith(path_join(realpath(path_join(root, name)), ''))]
+        yield root, dir_names, file_names
+
+
+def remote_host(*urls):
+    for url in urls:
+        if is_sftp(url) or is_ftp(url):
+            return splitscheme(url)[1].split('/')[0]
+    return None
+
+
+class SftpCopyFileTask(CopyTask):
+    def __init__(self, src_url, dst_url, size=None, priority=BULK):
+        # INTERACTIVE for copies the user waits on, such as a file opened in the editor
+        super().__init__('Copying ' + url_basename(src_url), host=remote_host(src_url, dst_url), priority=priority)
+        self._src_url = src_url
+        self._dst_url = dst_url
+        self._size_known = False
+        if size is None:
+            size = self._cached_size(src_url)
+        if size is not None:
+            self.set_size(size)
+
+    @property
+    def src_url(self):
+        return self._src_url
+
+    @property
+    def size_known(self):
+        return self._size_known
+
+    def set_size(self, size):
+        super().set_size(size)
+        self._size_known = True
+
+    def _run(self):
+        if not self._size_known:
+            self._set_size(self._src_url)
+        # Empty files are copied as well, the cached size only drives the progress
+        self._copy(self._src_url, self._dst_url)
+        self._file_done()
+
+    def _cached_size(self, src_url):
         _, src_path = splitscheme(src_url)
 
         if is_sftp(src_url):
-            with SftpWrapper(src_url) as sftp:
-                self.set_size(sftp.conn.stat(sftp.path).st_size)
+            return SftpCache.get(src_path, 'size')
         elif is_file(src_url):
-            self.set_size(getsize(src_path))
+            return getsize(src_path)
         else:
             raise UnsupportedOperation
 
+    def _set_size(self, src_url):
+        with SftpBackgroundWrapper(src_url, priority=self._priority) as sftp:
+            self.set_size(sftp_retry(sftp, lambda conn: conn.stat(sftp.path)).st_size)
+
     def _copy(self, src_url, dst_url):
         _, src_path = splitscheme(src_url)
         _, dst_path = splitscheme(dst_url)
+        compressible = is_compressible(src_path)
 
+        # Up- and downloads resume where they stopped if the connection drops
         if is_sftp(src_url) and is_file(dst_url):
-            with SftpBackgroundWrapper(src_url) as sftp:
-                sftp.conn.get(sftp.path, dst_path, callback=self._callback)
+            with SftpBackgroundWrapper(src_url, priority=self._priority, compressible=compressible) as sftp:
+                result, = self._transfer_file(sftp, ('download', sftp.path, dst_path))
+            if isinstance(result, Exception):
+                raise result
         elif is_file(src_url) and is_sftp(dst_url):
-            with SftpBackgroundWrapper(dst_url) as sftp:
+            with SftpBackgroundWrapper(dst_url, priority=self._priority, compressible=compressible) as sftp:
                 try:
-                    sftp.conn.put(src_path, sftp.path, callback=self._callback)
-                except (IOError, OSError, paramiko.sftp.SFTPError):
-                    self.show_alert("Connection error")
+                    result, = self._transfer_file(sftp, ('upload', src_path, sftp.path))
+                except (IOError, OSError, EOFError, paramiko.SSHException) as error:
+                    result = error
+            if isinstance(result, Exception):
+                self.show_alert("Connection error")
             SftpCache.put(dst_path, 'is_dir', False)
         elif is_sftp(src_url) and is_sftp(dst_url):
-            with SftpBackgroundWrapper(src_url) as src_sftp, SftpBackgroundWrapper(dst_url) as dst_sftp:
+            with SftpBackgroundWrapper(src_url, priority=self._priority, compressible=compressible) as src_sftp, \
+                    SftpBackgroundWrapper(dst_url, priority=self._priority, compressible=compressible) as dst_sftp:
                 with src_sftp.conn.open(src_sftp.path) as src_file:
                     dst_sftp.conn.putfo(
                         src_file, dst_sftp.path, callback=self._callback)
@@ -285,9 +624,220 @@ class SftpCopyFileTask(Task):
         except Exception:
             notify_file_changed(dst_url)
 
+    def _transfer_file(self, sftp, item):
+        return resumable_transfer(sftp, [item], callback=lambda index, size: self._add_progress(size),
+                                  on_retry=self._count_retry)
+
     def _callback(self, size, file_size):
-        self.set_progress(size)
-        self.check_canceled()
+        self._add_progress(size - self._size_written)
+
+
+class SftpMultiCopyTask(CopyTask):
+    def __init__(self, src_url, dst_url, files, size):
+        super().__init__('Copying ' + url_basename(src_url), size=size, host=remote_host(src_url, dst_url))
+        self._src_url = src_url
+        self._dst_url = dst_url
+        self._files = files
+        self.file_count = len(files)
+
+    def _run(self):
+        _, src_path = splitscheme(self._src_url)
+        _, dst_path = splitscheme(self._dst_url)
+        remote_url = self._src_url if is_sftp(self._src_url) else self._dst_url
+
+        results = [None] * len(self._files)
+        # Compressible files go over the compressed transport of adaptive hosts
+        for compressible in (True, False):
+            indexes = [index for index, fname in enumerate(self._files) if is_compressible(fname) == compressible]
+            if not indexes:
+                continue
+            with SftpBackgroundWrapper(remote_url, compressible=compressible) as sftp:
+                items = []
+                for index in indexes:
+                    fname = self._files[index]
+                    if is_sftp(self._src_url):
+                        items.append(('download', posixpath.join(sftp.path, fname), path_join(dst_path, fname)))
+                    else:
+                        items.append(('upload', path_join(src_path, fname), posixpath.join(sftp.path, fname)))
+                transferred = resumable_transfer(sftp, items, callback=self._callback,
+                                                 done_callback=self._done_callback, on_retry=self._count_retry)
+                for index, result in zip(indexes, transferred):
+                    results[index] = result
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        for fname, result in zip(self._files, results):
+            if is_sftp(self._dst_url) and not isinstance(result, Exception):
+                SftpCache.put(posixpath.join(dst_path, fname), 'is_dir', False)
+        try:
+            notify_file_added(self._dst_url)
+        except Exception:
+            notify_file_changed(self._dst_url)
+        if errors:
+            self.show_alert('%d of %d files could not be copied: %s' % (len(errors), len(results), errors[0]))
+
+    def _callback(self, index, size):
+        self._add_progress(size)
+
+    def _done_callback(self, index):
+        self._file_done()
+
+
+class SftpTarCopyTask(CopyTask):
+    def __init__(self, src_url, dst_url, size, file_count, fallback, compressible=False):
+        super().__init__('Copying ' + url_basename(src_url), size=size, host=remote_host(src_url, dst_url))
+        self._src_url = src_url
+        self._dst_url = dst_url
+        self._fallback = fallback
+        self._compressible = compressible
+        self.file_count = file_count
+        # Regular files the tar stream brought, others are left to the fallback
+        self._extracted = set()
+        self._skipped = False
+        self._tar_files = 0
+
+    def _run(self):
+        _, src_path = splitscheme(self._src_url)
+        _, dst_path = splitscheme(self._dst_url)
+        remote_url = self._src_url if is_sftp(self._src_url) else self._dst_url
+
+        with SftpBackgroundWrapper(remote_url, compressible=self._compressible) as sftp:
+            if is_sftp(self._src_url):
+                command = sftp_command('tar', 'cf', '-', '-C', sftp.path, '.')
+            else:
+                command = sftp_command('mkdir', '-p', sftp.path) + ' && ' + \
+                    sftp_command('tar', 'xf', '-', '-C', sftp.path)
+            try:
+                self._run_tar(sftp.conn, command, src_path, dst_path)
+                failed = False
+            except (OSError, EOFError, tarfile.TarError, paramiko.SSHException):
+                failed = True
+
+        # The server could not run tar or it failed part way: the rest goes
+        # file by file, as do members such as symlinks that were not extracted
+        if failed or self._skipped:
+            if failed and is_file(self._src_url):
+                self._take_back(self._size_written, self._tar_files)
+            for task in self._fallback(self._extracted):
+                task.attach(self)
+                task()
+            return
+
+        if is_sftp(self._dst_url):
+            SftpCache.put(dst_path, 'is_dir', True)
+        try:
+            notify_file_added(self._dst_url)
+        except Exception:
+            notify_file_changed(self._dst_url)
+
+    def _run_tar(self, conn, command, src_path, dst_path):
+        channel = sftp_exec_channel(conn, command, stdin=is_file(self._src_url))
+        with closing(channel):
+            try:
+                if is_sftp(self._src_url):
+                    self._extract(channel, dst_path)
+                else:
+                    self._archive(channel, src_path)
+                    channel.shutdown_write()
+            except (OSError, EOFError, tarfile.TarError):
+                # A tar that could not run leaves an empty or closed stream
+                sftp_exit_status(channel, Config.sftp_exec_timeout)
+                raise
+            status = sftp_exit_status(channel)
+            if status != 0:
+                errors = channel.makefile_stderr('rb').read().decode('utf-8', 'replace').strip()
+                raise OSError(errors or 'tar failed on the server')
+
+    def _archive(self, channel, src_path):
+        # Symlinks are archived as what they point to, as the file by file copy does
+        with channel.makefile('wb') as stream, tarfile.open(fileobj=stream, mode='w|', dereference=True) as tar:
+            for root, dir_names, file_names in walk_local(src_path):
+                for name in dir_names + file_names:
+                    path = path_join(root, name)
+                    tarinfo = tar.gettarinfo(path, relpath(path, src_path).replace(sep, '/'))
+                    if tarinfo.isreg():
+                        with open(path, 'rb') as src_file:
+                            tar.addfile(tarinfo, ProgressReader(src_file, self._add_progress))
+                        self._tar_files += 1
+                        self._file_done()
+                    else:
+                        tar.addfile(tarinfo)
+
+    def _extract(self, channel, dst_path):
+        with tarfile.open(fileobj=channel.makefile('rb'), mode='r|') as tar:
+            for member in tar:
+                # Only plain files and directories that stay inside dst_path
+                if member.name.startswith('/') or '..' in member.name.split('/'):
+                    continue
+                if member.isdir():
+                    tar.extract(member, dst_path)
+                elif member.isreg():
+                    tar.extract(member, dst_path)
+                    self._add_progress(member.size)
+                    self._extracted.add(posixpath.normpath(member.name))
+                    self._tar_files += 1
+                    self._file_done()
+                else:
+                    self._skipped = True
+
+    def add_progress(self, size):
+        # Progress of the file by file fallback
+        self._add_progress(size)
+
+    def file_done(self):
+        self._file_done()
+
+
+class ProgressReader():
+    def __init__(self, fileobj, callback):
+        self._fileobj = fileobj
+        self._callback = callback
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._callback(len(data))
+        return data
+
+
+class SftpDirSizeTask(Task):
+    def __init__(self, urls):
+        super().__init__('Calculating size of ' + ', '.join(map(url_basename, urls)))
+        self._urls = urls
+
+    def __call__(self):
+        self.set_size(len(self._urls))
+        with SftpBackgroundWrapper(self._urls[0], priority=INTERACTIVE) as sftp:
+            paths = [SftpWrapper.parse_path(splitscheme(url)[1])[1] for url in self._urls]
+            try:
+                sizes = self._du(sftp.conn, paths)
+            except (OSError, paramiko.SSHException, ValueError):
+                sizes = {path: self._walk_size(sftp.conn, path) for path in paths}
+        for url, path in zip(self._urls, paths):
+            SftpCache.put(splitscheme(url)[1], 'dir_size', sizes.get(path))
+            notify_file_changed(url)
+        show_status_message('Size calculated.')
+
+    def _du(self, conn, paths):
+        sizes = []
+        # du reports its arguments in order, one line each. A server that
+        # cannot run it, stays silent too long or has no -b (BSD du) gets
+        # the walk instead.
+        for line in sftp_exec(conn, sftp_command('du', '-sb', '--', *paths), on_wait=self.check_canceled):
+            sizes.append(int(line.split('\t', 1)[0]))
+            self.set_progress(len(sizes))
+            self.check_canceled()
+        if len(sizes) != len(paths):
+            raise ValueError('Unexpected du output')
+        return dict(zip(paths, sizes))
+
+    def _walk_size(self, conn, path):
+        # What du -sb counts: the apparent size of every entry, directories
+        # and the directory itself included
+        size = conn.lstat(path).st_size
+        for _, entries in sftp_walk(conn, path):
+            size += sum(attr.st_size for attr in entries)
+            self.check_canceled()
+        self.set_progress(self.get_progress() + 1)
+        return size
 
 
 class FtpFileSystem(FileSystem):
@@ -326,7 +876,11 @@ class FtpFileSystem(FileSystem):
             else:
                 with FtpWrapper(FtpConfig.get_host_url(path)) as ftp:
                     FtpCache.clear(path, 'is_dir', only_content=True)
-                    for file_attributes in ftp.list_files():
+                    if NetworkLoop.is_enabled():
+                        listing = NetworkLoop.result(AsyncFtp.list_files(FtpConfig.get_host_url(path)), Config.ftp_timeout)
+                    else:
+                        listing = ftp.list_files()
+                    for file_attributes in listing:
                         name = file_attributes[0]
                         if name == '..':
                             continue
@@ -383,6 +937,8 @@ class FtpFileSystem(FileSystem):
         if is_ftp(dst_url) and not self._is_server_path(dst_path):
             show_status_message('Destination path invalid.')
             return []
+        if (is_ftp(src_url) and self.is_dir(splitscheme(src_url)[1])) or (is_file(src_url) and fs.is_dir(src_url)):
+            return [CopyTreeTask(src_url, dst_url, lambda: self._prepare_copy(src_url, dst_url))]
         return self._prepare_copy(src_url, dst_url)
 
     def _prepare_copy(self, src_url, dst_url):
@@ -487,41 +1043,64 @@ class FtpFileSystem(FileSystem):
         dt_mtime = datetime.utcfromtimestamp(timestamp)
 
         FtpCache.put(path, 'is_dir', bool(isdirectory))
+        FtpCache.put(path, 'size', size)
         self.cache.put(path, 'size_bytes', size)
         self.cache.put(path, 'modified_datetime', dt_mtime)
         self.cache.put(path, 'get_permissions', permissions)
 
 
-class FtpCopyFileTask(Task):
-    def __init__(self, src_url, dst_url):
-        super().__init__('Copying ' + url_basename(src_url))
+class FtpCopyFileTask(CopyTask):
+    def __init__(self, src_url, dst_url, priority=BULK):
+        super().__init__('Copying ' + url_basename(src_url), host=remote_host(src_url, dst_url), priority=priority)
         self._src_url = src_url
         self._dst_url = dst_url
-        self._size_written = 0
-        self._set_size(src_url)
-
-    def __call__(self):
-        if self.get_size() > 0:
-            self._copy(self._src_url, self._dst_url)
-        else:
-            touch(self._dst_url)
-
-    def _set_size(self, src_url):
+        self._size_known = False
+        size = self._cached_size(src_url)
+        if size is not None:
+            self.set_size(size)
+
+    def set_size(self, size):
+        super().set_size(size)
+        self._size_known = True
+
+    def _run(self):
+        if not self._size_known:
+            self._set_size(self._src_url)
+        # Empty files are copied as well, the cached size only drives the progress
+        self._copy(self._src_url, self._dst_url)
+        self._file_done()
+
+    def _cached_size(self, src_url):
         _, src_path = splitscheme(src_url)
 
         if is_ftp(src_url):
-            with FtpWrapper(FtpConfig.get_host_url(src_url)) as ftp:
-                self.set_size(ftp.conn.size(ftp.path))
+            return FtpCache.get(src_path, 'size')
         elif is_file(src_url):
-            self.set_size(getsize(src_path))
+            return getsize(src_path)
         else:
             raise UnsupportedOperation
 
+    def _set_size(self, src_url):
+        if NetworkLoop.is_enabled():
+            self.set_size(NetworkLoop.result(AsyncFtp.size(FtpConfig.get_host_url(src_url)), Config.ftp_timeout))
+            return
+        with FtpBackgroundWrapper(FtpConfig.get_host_url(src_url)) as ftp:
+            self.set_size(ftp.conn.size(ftp.path))
+
     def _copy(self, src_url, dst_url):
         _, src_path = splitscheme(src_url)
         _, dst_path = splitscheme(dst_url)
 
-        if is_ftp(src_url) and is_file(dst_url):
+        if NetworkLoop.is_enabled() and is_ftp(src_url) and is_file(dst_url):
+            with open(dst_path, 'wb') as dst_file:
+                self._await_transfer(lambda progress, paused: AsyncFtp.retrieve(
+                    FtpConfig.get_host_url(src_url), dst_file.write, progress, paused))
+        elif NetworkLoop.is_enabled() and is_file(src_url) and is_ftp(dst_url):
+            with open(src_path, 'rb') as src_file:
+                self._await_transfer(lambda progress, paused: AsyncFtp.store(
+                    FtpConfig.get_host_url(dst_url), src_file, progress, paused))
+            FtpCache.put(dst_path, 'is_dir', False)
+        elif is_ftp(src_url) and is_file(dst_url):
             with FtpBackgroundWrapper(FtpConfig.get_host_url(src_url)) as ftp, open(dst_path, 'wb') as dst_file:
                 def callback(data):
                     dst_file.write(data)
@@ -547,9 +1126,7 @@ class FtpCopyFileTask(Task):
             notify_file_changed(dst_url)
 
     def _callback(self, data):
-        self._size_written += len(data)
-        self.set_progress(self._size_written)
-        self.check_canceled()
+        self._add_progress(len(data))
 
 
 class NetworkFileSystem(FileSystem):
@@ -1,10 +1,13 @@
+import time
 from urllib.parse import urlparse
-from ftplib import FTP
+from ftplib import FTP, all_errors
+from threading import Lock, RLock, Thread
 
 from fman import load_json, save_json, show_status_message
 from fman.url import join as url_join, normalize as url_normalize
 
 from .config import Config
+from .connections import ConnectionPool, HostRegistry
 
 #
 # In order to load the ftpparser library, we need to put the
@@ -60,8 +63,130 @@ class FtpConfig():
         FtpConfig._config = value
 
 
+class FtpConnection(FTP):
+    #
+    # Remembers when the server last answered, so liveness only costs a
+    # NOOP after Config.ftp_idle_probe quiet seconds. A failed read or
+    # write marks the connection dead right away. Commands hold the lock,
+    # so background keepalives never interleave with them.
+    #
+    kind = None
+
+    def __init__(self, url):
+        self.url = url
+        self.last_reply = time.monotonic()
+        self.broken = False
+        self.lock = RLock()
+        super().__init__(host=url.hostname, user=url.username, passwd=url.password)
+
+    def is_alive(self):
+        if self.broken or self.sock is None:
+            return False
+        if time.monotonic() - self.last_reply < Config.ftp_idle_probe:
+            return True
+        return self.probe()
+
+    def probe(self):
+        # Any error reply, such as 421 before the server hangs up, means dead
+        try:
+            self.voidcmd('NOOP')
+        except all_errors:
+            self.broken = True
+        return not self.broken
+
+    def putline(self, line):
+        try:
+            super().putline(line)
+        except OSError:
+            self.broken = True
+            raise
+
+    def getmultiline(self):
+        try:
+            line = super().getmultiline()
+        except (OSError, EOFError):
+            self.broken = True
+            raise
+        self.last_reply = time.monotonic()
+        return line
+
+    def sendcmd(self, cmd):
+        with self.lock:
+            return super().sendcmd(cmd)
+
+    def voidcmd(self, cmd):
+        with self.lock:
+            return super().voidcmd(cmd)
+
+    def retrbinary(self, *args, **kwargs):
+        with self.lock:
+            return super().retrbinary(*args, **kwargs)
+
+    def retrlines(self, *args, **kwargs):
+        with self.lock:
+            return super().retrlines(*args, **kwargs)
+
+    def storbinary(self, *args, **kwargs):
+        with self.lock:
+            return super().storbinary(*args, **kwargs)
+
+    def storlines(self, *args, **kwargs):
+        with self.lock:
+            return super().storlines(*args, **kwargs)
+
+    def size(self, filename):
+        # Listings switch to ASCII mode, SIZE is only reliable in binary mode
+        with self.lock:
+            self.voidcmd('TYPE I')
+            return super().size(filename)
+
+
+class FtpKeepalive():
+    #
+    # Sends a NOOP on foreground connections that were quiet for
+    # Config.ftp_keepalive_interval seconds, so servers do not drop them
+    # for idling, and reconnects the ones that failed in the meantime.
+    #
+    _thread = None
+    _lock = Lock()
+
+    @staticmethod
+    def start():
+        with FtpKeepalive._lock:
+            if FtpKeepalive._thread is None:
+                FtpKeepalive._thread = Thread(target=FtpKeepalive._run, daemon=True)
+                FtpKeepalive._thread.start()
+
+    @staticmethod
+    def _run():
+        while True:
+            time.sleep(Config.ftp_keepalive_interval)
+            for host, connection in FtpWrapper._connections.items():
+                try:
+                    FtpKeepalive._check(host, connection)
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _check(host, connection):
+        if time.monotonic() - connection.last_reply < Config.ftp_keepalive_interval:
+            return
+        # A busy connection is obviously alive
+        if not connection.lock.acquire(blocking=False):
+            return
+        try:
+            alive = connection.probe()
+        finally:
+            connection.lock.release()
+        if not alive:
+            replacement = FtpWrapper.connection(connection.url)
+            if not FtpWrapper._connections.replace(host, connection, replacement):
+                replacement.close()
+            connection.close()
+
+
 class FtpWrapper():
-    _connections = {}
+    _connections = HostRegistry()
 
     def __init__(self, url):
         self._url = urlparse(url)
@@ -71,7 +196,14 @@ class FtpWrapper():
             return self
         show_status_message('Connecting to %s...' % (self.host,))
         try:
-            FtpWrapper._connections[self.host] = FtpWrapper.connection(self._url)
+            stale = FtpWrapper._connections.get(self.host)
+            connection = FtpWrapper.connection(self._url)
+            # Another thread may have connected the host meanwhile
+            if FtpWrapper._connections.replace(self.host, stale, connection):
+                connection = stale
+            if connection is not None:
+                connection.close()
+            FtpKeepalive.start()
             show_status_message('Ready.')
         except EOFError:
             show_status_message('Connection error.')
@@ -84,7 +216,11 @@ class FtpWrapper():
     def conn(self):
         if not self._is_connected():
             raise Exception('Not connected')
-        return FtpWrapper._connections[self.host]
+        FtpBackgroundWrapper._pool.touch(self.host)
+        connection = FtpWrapper._connections.get(self.host)
+        if connection is None:
+            raise Exception('Not connected')
+        return connection
 
     @property
     def host(self):
@@ -100,14 +236,14 @@ class FtpWrapper():
 
     @staticmethod
     def close_connection(host):
-        if host not in FtpWrapper._connections:
+        FtpBackgroundWrapper.close_idle(host)
+        connection = FtpWrapper._connections.pop(host, None)
+        if connection is None:
             return
         try:
-            FtpWrapper._connections[host].quit()
+            connection.quit()
         except Exception:
             pass
-        finally:
-            del FtpWrapper._connections[host]
 
     def list_files(self):
         cmd = 'LIST'
@@ -118,20 +254,25 @@ class FtpWrapper():
 
     @staticmethod
     def connection(url):
-        ftp = FTP(host=url.hostname, user=url.username, passwd=url.password)
+        ftp = FtpConnection(url)
         ftp.encoding = 'utf-8'
+        ftp.voidcmd('TYPE I')
         return ftp
 
     def _is_connected(self):
-        if self.host not in FtpWrapper._connections:
-            return False
-        try:
-            FtpWrapper._connections[self.host].voidcmd('TYPE I')
-            return True
-        except Exception:
-            return False
+        connection = FtpWrapper._connections.get(self.host)
+        return connection is not None and connection.is_alive()
 
 class FtpBackgroundWrapper():
+    # Transfers share the per host connection limit of the pool with the
+    # foreground connection and the connections of the asyncio core
+    _pool = ConnectionPool(
+        close=lambda connection: FtpBackgroundWrapper._close(connection),
+        is_alive=lambda connection: connection.is_alive(),
+        kind_of=lambda connection: connection.kind,
+        foreground=FtpWrapper._connections,
+        close_host=lambda host: FtpWrapper.close_connection(host))
+
     def __init__(self, url):
         self._url = urlparse(url)
         self._background_connection = None
@@ -140,16 +281,31 @@ class FtpBackgroundWrapper():
         if self._is_connected():
             return self
         try:
-            self._background_connection = FtpWrapper.connection(self._url)
+            self._background_connection = FtpBackgroundWrapper._pool.acquire(
+                self.host, lambda: FtpWrapper.connection(self._url))
         except EOFError:
             pass
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        if self._background_connection:
+            FtpBackgroundWrapper._pool.release(self.host, self._background_connection, reuse=exc_type is None)
+            self._background_connection = None
+
+    @staticmethod
+    def get_connection_counts():
+        return FtpBackgroundWrapper._pool.get_counts()
+
+    @staticmethod
+    def close_idle(host):
+        FtpBackgroundWrapper._pool.close_idle(host)
+
+    @staticmethod
+    def _close(connection):
         try:
-            self._background_connection.quit()
+            connection.quit()
         except Exception:
-            pass
+            connection.close()
 
     @property
     def conn(self):
@@ -168,8 +324,4 @@ class FtpBackgroundWrapper():
     def _is_connected(self):
         if not self._background_connection:
             return False
-        try:
-            self._background_connection.voidcmd('TYPE I')
-            return True
-        except Exception:
-            return False
+        return self._background_connection.is_alive()
@@ -0,0 +1,202 @@
+import time
+from itertools import count
+from threading import Condition
+
+from fman import Task, show_status_message
+
+from .config import Config
+
+
+class Transfer():
+    _smoothing = 0.3
+    _sample_interval = 0.5
+    _ids = count(1)
+
+    def __init__(self, title, host, size=0, interactive=False):
+        self.id = next(Transfer._ids)
+        self.title = title
+        self.host = host
+        self.size = size
+        # Transfers the user waits on start right away, outside the per host slots
+        self.interactive = interactive
+        self.bytes = 0
+        self.rate = 0
+        self.retries = 0
+        self.priority = 0
+        self.paused = False
+        self.canceled = False
+        self.state = 'queued'
+        self._started = None
+        self._sample_time = None
+        self._sample_bytes = 0
+
+    @property
+    def eta(self):
+        if not self.rate or self.size <= self.bytes:
+            return None
+        return (self.size - self.bytes) / self.rate
+
+    def start(self):
+        self.state = 'active'
+        self._started = self._sample_time = time.monotonic()
+
+    def cancel(self):
+        self.canceled = True
+        TransferMetrics.notify()
+
+    def check(self):
+        # Blocks while paused, raises once canceled from the dashboard
+        while self.paused and not self.canceled:
+            time.sleep(0.2)
+        if self.canceled:
+            raise Task.Canceled()
+
+    def add(self, size):
+        self.bytes += size
+        TransferMetrics.add_host_bytes(self.host, size)
+        now = time.monotonic()
+        elapsed = now - self._sample_time
+        if elapsed >= self._sample_interval:
+            # Exponential moving average of the throughput
+            sample = (self.bytes - self._sample_bytes) / elapsed
+            self.rate = sample if not self.rate else \
+                self._smoothing * sample + (1 - self._smoothing) * self.rate
+            self._sample_time = now
+            self._sample_bytes = self.bytes
+            return True
+        return False
+
+    def take_back(self, size):
+        # Bytes sent again by what replaces them; the host total keeps them,
+        # they did go over the wire
+        self.bytes -= size
+        self._sample_bytes = self.bytes
+        self._sample_time = time.monotonic()
+
+    def finish(self):
+        self.state = 'done'
+        self.rate = 0
+        TransferMetrics.remove(self)
+        TransferMetrics.notify()
+
+    def describe(self):
+        text = '%s of %s' % (format_size(self.bytes), format_size(self.size))
+        if self.paused:
+            text += ', paused'
+        if self.retries:
+            text += ', %d retries' % self.retries
+        if self.rate:
+            text += ', %s/s' % format_size(self.rate)
+        if self.eta is not None:
+            text += ', %s left' % format_duration(self.eta)
+        return text
+
+
+class TransferMetrics():
+    _transfers = []
+    _host_bytes = {}
+    _lock = Condition()
+    _status_shown = 0
+
+    @staticmethod
+    def acquire(transfer):
+        # Queues the transfer and waits for a free slot on the host, highest priority first
+        with TransferMetrics._lock:
+            TransferMetrics._transfers.append(transfer)
+            while not transfer.canceled and not transfer.interactive and not TransferMetrics._may_start(transfer):
+                TransferMetrics._lock.wait(0.5)
+            if not transfer.canceled:
+                transfer.start()
+        transfer.check()
+
+    @staticmethod
+    def notify():
+        with TransferMetrics._lock:
+            TransferMetrics._lock.notify_all()
+
+    @staticmethod
+    def get_transfer(transfer_id):
+        with TransferMetrics._lock:
+            for transfer in TransferMetrics._transfers:
+                if transfer.id == transfer_id:
+                    return transfer
+        return None
+
+    @staticmethod
+    def move_to_front(transfer):
+        with TransferMetrics._lock:
+            transfer.priority = max(other.priority for other in TransferMetrics._transfers) + 1
+            TransferMetrics._lock.notify_all()
+
+    @staticmethod
+    def move_to_back(transfer):
+        with TransferMetrics._lock:
+            transfer.priority = min(other.priority for other in TransferMetrics._transfers) - 1
+            TransferMetrics._lock.notify_all()
+
+    @staticmethod
+    def _may_start(transfer):
+        same_host = [other for other in TransferMetrics._transfers
+                     if other.host == transfer.host and not other.interactive]
+        # A paused transfer gives its slot to the next one until it resumes
+        if sum(other.state == 'active' and not other.paused for other in same_host) >= Config.max_transfers_per_host:
+            return False
+        # Listed transfers that are still queued are all waiting in acquire
+        queued = [other for other in same_host if other.state == 'queued' and not other.canceled]
+        return min(queued, key=lambda other: (-other.priority, other.id)) is transfer
+
+    @staticmethod
+    def remove(transfer):
+        with TransferMetrics._lock:
+            if transfer in TransferMetrics._transfers:
+                TransferMetrics._transfers.remove(transfer)
+
+    @staticmethod
+    def add_host_bytes(host, size):
+        with TransferMetrics._lock:
+            TransferMetrics._host_bytes[host] = TransferMetrics._host_bytes.get(host, 0) + size
+
+    @staticmethod
+    def get_transfers(state=None):
+        with TransferMetrics._lock:
+            return [transfer for transfer in TransferMetrics._transfers if state in (None, transfer.state)]
+
+    @staticmethod
+    def get_host_stats():
+        stats = {}
+        with TransferMetrics._lock:
+            for host, size in TransferMetrics._host_bytes.items():
+                stats[host] = {'bytes': size, 'rate': 0, 'active': 0, 'queued': 0}
+            for transfer in TransferMetrics._transfers:
+                host_stats = stats.setdefault(transfer.host, {'bytes': 0, 'rate': 0, 'active': 0, 'queued': 0})
+                host_stats[transfer.state] += 1
+                host_stats['rate'] += transfer.rate
+        return stats
+
+    @staticmethod
+    def get_summary():
+        active = TransferMetrics.get_transfers('active')
+        queued = TransferMetrics.get_transfers('queued')
+        return '%d active, %d queued transfers, %s/s' % (
+            len(active), len(queued), format_size(sum(transfer.rate for transfer in active)))
+
+    @staticmethod
+    def show_status(force=False):
+        now = time.monotonic()
+        if force or now - TransferMetrics._status_shown > 1:
+            TransferMetrics._status_shown = now
+            show_status_message(TransferMetrics.get_summary())
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds) if hours else '%d:%02d' % (minutes, seconds)
@@ -1,7 +1,19 @@
-from fman import show_prompt, show_status_message
+import fnmatch
+import ipaddress
+import os
+import posixpath
+import socket
+import stat
+import time
+from shlex import quote
+from threading import Condition, Lock, Thread
+
+from fman import load_json, save_json, show_prompt, show_status_message
 from fman.url import splitscheme
 
+from .cache import FileCache
 from .config import Config
+from .connections import ConnectionPool, HostRegistry
 
 #
 # In order to load the Paramiko library, we need to put the
@@ -15,6 +27,123 @@ except ImportError:
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
     import paramiko
 
+from paramiko.sftp import (CMD_ATTRS, CMD_CLOSE, CMD_HANDLE, CMD_MKDIR,
+                           CMD_NAME, CMD_OPEN, CMD_OPENDIR, CMD_READDIR,
+                           CMD_REMOVE, CMD_RENAME, CMD_RMDIR, CMD_SETSTAT,
+                           CMD_STAT, CMD_STATUS, SFTP_FLAG_CREATE,
+                           SFTP_FLAG_TRUNC, SFTP_FLAG_WRITE)
+
+from .ssh import SshTransport
+
+# What a dropped or hung connection raises from the SFTP client
+CONNECTION_ERRORS = (EOFError, OSError, paramiko.SSHException)
+
+# Exit statuses of a shell that could not run a command, and the line
+# that tells a shell apart from a server only running SFTP
+EXEC_NOT_RUN = (126, 127)
+EXEC_MARKER = 'fman-exec'
+
+
+class ExecUnavailable(paramiko.SSHException):
+    pass
+
+
+class SharedSftpClient(paramiko.SFTPClient):
+    #
+    # An SFTP session that threads can use at the same time. One thread at
+    # a time reads from the channel and hands each response to the thread
+    # waiting for its request number, where paramiko's client would drop
+    # replies that another thread happens to read. Requests are written
+    # one whole packet at a time.
+    #
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self._replies = {}
+        self._reading = False
+        self._failure = None
+        self._reply_ready = Condition(Lock())
+        self._sending = Lock()
+        # A transport opened for this session alone
+        self.owned_transport = None
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.owned_transport is not None:
+                self.owned_transport.close()
+
+    def _async_request(self, fileobj, t, *arg):
+        # paramiko sends outside its lock, a packet written in several
+        # parts could interleave with the request of another thread
+        with self._sending:
+            return super()._async_request(fileobj, t, *arg)
+
+    def _read_response(self, waitfor=None):
+        try:
+            return self._wait_response(waitfor)
+        except BaseException:
+            if waitfor is not None:
+                # Nobody waits for this reply any more, it is dropped when it comes
+                with self._lock:
+                    self._expecting.pop(waitfor, None)
+                with self._reply_ready:
+                    self._replies.pop(waitfor, None)
+            raise
+
+    def _wait_response(self, waitfor):
+        while True:
+            with self._reply_ready:
+                while waitfor not in self._replies and self._reading and self._failure is None:
+                    self._reply_ready.wait()
+                    if waitfor is None:
+                        # The reader dispatched the asynchronous responses meanwhile
+                        return None, None
+                if waitfor in self._replies:
+                    t, msg = self._replies.pop(waitfor)
+                    if t == CMD_STATUS:
+                        self._convert_status(msg)
+                    return t, msg
+                if self._failure is not None:
+                    raise self._failure
+                self._reading = True
+            try:
+                t, data = self._read_packet()
+            except EOFError as e:
+                self._stop_reading(paramiko.SSHException('Server connection dropped: {}'.format(e)))
+                raise self._failure
+            except BaseException as e:
+                # A timeout leaves the session usable for the other threads
+                self._stop_reading(None if isinstance(e, socket.timeout) else e)
+                raise
+            msg = paramiko.Message(data)
+            num = msg.get_int()
+            with self._lock:
+                fileobj = self._expecting.pop(num, None)
+            try:
+                # Dispatched while still the reader, so a woken waiter finds its reply
+                if fileobj is not None and fileobj is not type(None) and num != waitfor:
+                    fileobj._async_response(t, msg, num)
+            finally:
+                with self._reply_ready:
+                    self._reading = False
+                    if fileobj is type(None) and num != waitfor:
+                        self._replies[num] = (t, msg)
+                    self._reply_ready.notify_all()
+            if num == waitfor:
+                if t == CMD_STATUS:
+                    self._convert_status(msg)
+                return t, msg
+            if waitfor is None:
+                return None, None
+
+    def _stop_reading(self, failure):
+        with self._reply_ready:
+            self._reading = False
+            self._failure = failure
+            self._reply_ready.notify_all()
+
 
 class SftpConfig():
     _config = paramiko.config.SSHConfig.from_path(Config.sftp_file)
@@ -28,8 +157,94 @@ class SftpConfig():
         return SftpConfig._config.get_hostnames()
 
 
+class SftpTuning():
+    #
+    # Transport settings per host: a LAN or WAN profile, the RekeyLimit of
+    # the ssh config host block and the host's entry (or "*") in the
+    # plugin's tuning settings, later ones winning.
+    #
+    profiles = {
+        'lan': {
+            'window_size': 4 * 2 ** 20,
+            'max_packet_size': 2 ** 15,
+            'rekey_bytes': 2 ** 32,
+            'socket_buffer': 2 ** 20,
+            'tcp_nodelay': True,
+            'compression': 'no',
+        },
+        'wan': {
+            'window_size': 16 * 2 ** 20,
+            'max_packet_size': 2 ** 15,
+            'rekey_bytes': 2 ** 32,
+            'socket_buffer': 4 * 2 ** 20,
+            'tcp_nodelay': True,
+            'compression': 'no',
+        },
+    }
+
+    @staticmethod
+    def get_host(host_name):
+        host = SftpConfig.get_host(host_name)
+        settings = load_json(Config.sftp_tuning_file, default={}) or {}
+        overrides = dict(settings.get('*', {}), **settings.get(host_name, {}))
+        profile = overrides.pop('profile', None) or SftpTuning._guess_profile(host['hostname'])
+        tuning = dict(SftpTuning.profiles[profile])
+        rekey_bytes = SftpTuning._parse_size(host.get('rekeylimit', 'default').split()[0])
+        if rekey_bytes:
+            tuning['rekey_bytes'] = rekey_bytes
+        if 'compression' in host:
+            tuning['compression'] = host['compression'].lower()
+        tuning.update(overrides)
+        return tuning
+
+    @staticmethod
+    def use_compression(host_name, compressible=False):
+        # "adaptive" compresses only content worth it, on a second transport
+        mode = SftpTuning.get_host(host_name)['compression']
+        return mode == 'yes' or (mode == 'adaptive' and compressible)
+
+    @staticmethod
+    def apply_socket(sock, tuning):
+        if tuning['socket_buffer']:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, tuning['socket_buffer'])
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, tuning['socket_buffer'])
+        if tuning['tcp_nodelay']:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @staticmethod
+    def apply_transport(transport, tuning):
+        transport.packetizer.REKEY_BYTES = tuning['rekey_bytes']
+
+    @staticmethod
+    def _guess_profile(hostname):
+        try:
+            address = ipaddress.ip_address(hostname)
+        except ValueError:
+            return 'lan' if hostname == 'localhost' or hostname.endswith('.local') else 'wan'
+        return 'lan' if address.is_private or address.is_loopback or address.is_link_local else 'wan'
+
+    @staticmethod
+    def _parse_size(value):
+        # RekeyLimit syntax: 512M, 1G, or "default"
+        units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+        try:
+            if value[-1:].upper() in units:
+                return int(value[:-1]) * units[value[-1:].upper()]
+            return int(value)
+        except ValueError:
+            return None
+
+
 class SftpWrapper():
-    _connections = {}
+    # Transports, bastions and parked handshakes change under the lock of
+    # their key (see _host_lock), the registries keep single reads safe
+    _connections = HostRegistry()
+    _transports = HostRegistry()
+    _jumps = HostRegistry()
+    _parked = HostRegistry()
+    _passwords = HostRegistry()
+    _transport_locks = {}
+    _lock = Lock()
 
     def __init__(self, url):
         _, path = splitscheme(url)
@@ -40,7 +255,15 @@ class SftpWrapper():
             return self
         show_status_message('Connecting to %s...' % (self._host,))
         try:
-            SftpWrapper._connections[self._host] = SftpWrapper.connection(self._host)
+            stale = SftpWrapper._connections.get(self._host)
+            connection = SftpWrapper.connection(self._host)
+            # Another thread may have connected the host meanwhile
+            if SftpWrapper._connections.replace(self._host, stale, connection):
+                connection = stale
+            if connection is not None:
+                SftpBackgroundWrapper._close(connection)
+            SftpHealthMonitor.start()
+            SftpPrewarm.record(self._host)
             show_status_message('Ready.')
         except ValueError:
             show_status_message('Connection error.')
@@ -53,7 +276,11 @@ class SftpWrapper():
     def conn(self):
         if not self._is_connected():
             raise ValueError('Not connected')
-        return SftpWrapper._connections[self._host]
+        SftpBackgroundWrapper._pool.touch(self._host)
+        connection = SftpWrapper._connections.get(self._host)
+        if connection is None:
+            raise ValueError('Not connected')
+        return connection
 
     @property
     def host(self):
@@ -63,20 +290,17 @@ class SftpWrapper():
     def path(self):
         return self._path
 
+    def reconnect(self):
+        return SftpWrapper._reconnect(self._host)
+
     @staticmethod
     def get_all_active_connections():
         return SftpWrapper._connections.keys()
 
     @staticmethod
     def close_connection(host):
-        if host not in SftpWrapper._connections:
-            return
-        try:
-            SftpWrapper._connections[host].close()
-        except Exception:
-            pass
-        finally:
-            del SftpWrapper._connections[host]
+        SftpWrapper._close_host(host)
+        SftpWrapper._passwords.pop(host, None)
 
     @staticmethod
     def parse_path(path):
@@ -88,63 +312,542 @@ class SftpWrapper():
         return server_name, server_path
 
     @staticmethod
-    def connection(hostname):
-        host = SftpConfig.get_host(hostname)
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
+    def connection(hostname, compressible=False, interactive=True):
+        # Every SFTP session of a host is a channel on one SSH transport,
+        # or on the compressed one for compressible content
+        compress = SftpTuning.use_compression(hostname, compressible)
+        key = (hostname, compress)
+        with SftpWrapper._host_lock(key):
+            transport = SftpWrapper._transports.get(key)
+            if SftpWrapper._is_usable(transport):
+                try:
+                    return SftpWrapper._open_client(transport)
+                except paramiko.SSHException:
+                    # The server limits sessions per connection (MaxSessions), this
+                    # client gets a connection of its own that closes with it
+                    extra = SftpWrapper._connect(hostname, compress, interactive)
+                    try:
+                        return SftpWrapper._open_client(extra, owned=True)
+                    except Exception:
+                        extra.close()
+                        raise
+            SftpWrapper._transports[key] = transport = SftpWrapper._connect(hostname, compress, interactive)
+            return SftpWrapper._open_client(transport)
+
+    @staticmethod
+    def warm(hostname):
+        # Connects the transport of the host without prompting or opening a session
+        compress = SftpTuning.use_compression(hostname)
+        key = (hostname, compress)
+        with SftpWrapper._host_lock(key):
+            if not SftpWrapper._is_usable(SftpWrapper._transports.get(key)):
+                SftpWrapper._transports[key] = SftpWrapper._connect(hostname, compress, interactive=False)
+
+    @staticmethod
+    def is_warm(hostname):
+        # Connected, or a transport up or parked for its prompt; cheap, as it
+        # runs while the cursor moves over the hosts
+        if hostname in SftpWrapper._connections:
+            return True
+        for compress in (False, True):
+            key = (hostname, compress)
+            parked, _, _ = SftpWrapper._parked.get(key, (None, None, None))
+            if SftpWrapper._is_usable(SftpWrapper._transports.get(key)) or \
+                    (parked is not None and parked.is_active()):
+                return True
+        return False
+
+    @staticmethod
+    def get_compression_ratios():
+        counts = {}
+        for (hostname, compress), transport in SftpWrapper._transports.items():
+            if compress:
+                raw, compressed = counts.get(hostname, (0, 0))
+                counts[hostname] = (raw + transport.compression_counts[0], compressed + transport.compression_counts[1])
+        return {hostname: raw / compressed for hostname, (raw, compressed) in counts.items() if compressed}
+
+    @staticmethod
+    def _close_transport(hostname):
+        # Under the lock of the transport, so no session is opened on it meanwhile
+        for compress in (False, True):
+            key = (hostname, compress)
+            with SftpWrapper._host_lock(key):
+                transport = SftpWrapper._transports.pop(key, None)
+                parked, _, _ = SftpWrapper._parked.pop(key, (None, None, None))
+                for closing in (transport, parked):
+                    if closing is not None:
+                        closing.close()
+
+    @staticmethod
+    def _close_host(host):
+        # Everything of the host but its password, so it can come back without a prompt
+        SftpBackgroundWrapper.close_idle(host)
+        SftpWrapper._close_transport(host)
+        connection = SftpWrapper._connections.pop(host, None)
+        if connection is not None:
+            SftpBackgroundWrapper._close(connection)
+        SftpWrapper._close_unused_jumps()
+
+    @staticmethod
+    def _reconnect(host):
+        # Replaces a dropped foreground connection without prompting, True on success
+        dropped = SftpWrapper._connections.get(host)
+        if dropped is None:
+            return False
+        if SftpBackgroundWrapper._is_alive(dropped):
+            return True
+        try:
+            connection = SftpWrapper.connection(host, interactive=False)
+        except ValueError:
+            return False
+        if SftpWrapper._connections.replace(host, dropped, connection):
+            SftpBackgroundWrapper._close(dropped)
+            return True
+        # Another thread reconnected or the host was disconnected meanwhile
+        SftpBackgroundWrapper._close(connection)
+        return host in SftpWrapper._connections
+
+    @staticmethod
+    def _host_lock(key):
+        with SftpWrapper._lock:
+            return SftpWrapper._transport_locks.setdefault(key, Lock())
+
+    @staticmethod
+    def _is_usable(transport):
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    @staticmethod
+    def _open_client(transport, owned=False):
+        client = SharedSftpClient.from_transport(transport)
+        client.owned_transport = transport if owned else None
+        # A hung server fails the request instead of blocking forever
+        client.get_channel().settimeout(Config.sftp_timeout)
+        return client
+
+    @staticmethod
+    def _connect(hostname, compress=False, interactive=True, host=None):
+        # One handshake: keys and agent first, then the password on the same
+        # session. Without interactive, a handshake that needs a prompt is
+        # parked for the next interactive connect instead of being closed.
+        host = host or SftpConfig.get_host(hostname)
+        key = (hostname, compress)
+        transport, user, locked_keys = SftpWrapper._parked.pop(key, (None, host.get('user'), None))
+        if transport is None or not transport.is_active():
+            transport, locked_keys = SftpWrapper._handshake(hostname, host, compress, interactive), None
+
         try:
-            proxy = paramiko.ProxyCommand(host['proxycommand'])
+            if user is None and interactive:
+                user, ok = show_prompt('Please enter username')
+                if not ok or not user:
+                    raise ValueError
+            if user is not None and locked_keys is None:
+                locked_keys = SftpWrapper._auth_quietly(transport, hostname, user, host)
+            if not transport.is_authenticated():
+                if not interactive:
+                    SftpWrapper._parked[key] = (transport, user, locked_keys)
+                    transport = None
+                    raise ValueError
+                password, ok = show_prompt('Please enter password')
+                if not ok or not password:
+                    raise ValueError
+                SftpWrapper._auth_password(transport, user, password, locked_keys)
+                SftpWrapper._passwords[hostname] = password
         except Exception:
-            proxy = None
-        if 'user' in host:
-            user = host['user']
-        else:
-            user, ok = show_prompt('Please enter username')
-            if not ok or not user:
-                raise ValueError
-        if 'identityfile' in host:
-            key = host['identityfile']
+            if transport is not None:
+                transport.close()
+            raise ValueError
+        # Idle connections are kept open through NAT and firewall timeouts
+        transport.set_keepalive(Config.sftp_keepalive_interval)
+        return transport
+
+    @staticmethod
+    def _handshake(hostname, host, compress, interactive=True):
+        port = int(host.get('port', 22))
+        jump = host.get('proxyjump', 'none')
+        if jump.lower() != 'none':
+            # A channel of the shared bastion transport instead of a socket
+            proxy = SftpWrapper._jump_channel(jump, host['hostname'], port, interactive)
         else:
-            key = None
-        password = None
+            try:
+                proxy = paramiko.ProxyCommand(host['proxycommand'])
+            except Exception:
+                proxy = None
 
+        tuning = SftpTuning.get_host(hostname)
         try:
-            client.connect(hostname=host['hostname'], username=user, password=password, key_filename=key, sock=proxy)
+            sock = proxy or SftpWrapper._open_socket(host['hostname'], port, tuning)
+            transport = SshTransport(sock, default_window_size=tuning['window_size'],
+                                     default_max_packet_size=tuning['max_packet_size'])
+            transport.apply_config(host)
+            transport.use_compression(compress)
+            SftpTuning.apply_transport(transport, tuning)
+            transport.start_client()
+            SftpWrapper._check_host_key(transport, host['hostname'], port)
         except Exception:
-            password, ok = show_prompt('Please enter password')
-            if not ok or not password:
-                raise ValueError
+            raise ValueError
+        return transport
+
+    @staticmethod
+    def _jump_channel(jump, hostname, port, interactive):
+        hops = [hop.strip() for hop in jump.split(',')]
+        key = ','.join(hops)
+        with SftpWrapper._host_lock(('jump', key)):
+            transport = SftpWrapper._jumps.get(key)
+            if not SftpWrapper._is_usable(transport):
+                # The last hop is reached through the ones before it
+                name, host = SftpWrapper._jump_host(hops[-1], ','.join(hops[:-1]))
+                SftpWrapper._jumps[key] = transport = SftpWrapper._connect(name, interactive=interactive, host=host)
             try:
-                client.connect(hostname=host['hostname'], username=user, password=password, key_filename=key, sock=proxy)
-            except Exception:
+                # Still under the lock, so the bastion is not closed as unused meanwhile
+                return transport.open_channel('direct-tcpip', (hostname, port), ('127.0.0.1', 0))
+            except paramiko.SSHException:
                 raise ValueError
-        
-        return client.open_sftp()
+
+    @staticmethod
+    def _jump_host(hop, via):
+        # [ssh://][user@]host[:port] of a ProxyJump list, resolved through the ssh config
+        spec = hop[len('ssh://'):] if hop.startswith('ssh://') else hop
+        user, _, address = spec.rpartition('@')
+        if address.startswith('['):
+            name, _, port = address[1:].partition(']')
+            port = port.lstrip(':')
+        else:
+            name, _, port = address.partition(':')
+        host = dict(SftpConfig.get_host(name))
+        if user:
+            host['user'] = user
+        if port:
+            host['port'] = port
+        if via:
+            host['proxyjump'] = via
+        elif host.get('proxyjump', '').split(',')[-1].strip() == hop:
+            del host['proxyjump']
+        return name, host
+
+    @staticmethod
+    def _close_unused_jumps():
+        # Bastion transports without any forwarded connection left, the
+        # hops of a chain one after the other
+        closed = True
+        while closed:
+            closed = False
+            for key, transport in SftpWrapper._jumps.items():
+                with SftpWrapper._host_lock(('jump', key)):
+                    if any(not channel.closed for channel in transport._channels.values()) or \
+                            not SftpWrapper._jumps.remove(key, transport):
+                        continue
+                    transport.close()
+                    closed = True
+
+    @staticmethod
+    def _auth_quietly(transport, hostname, user, host):
+        # Everything that needs no prompt, returns the key files that need a passphrase
+        locked_keys = SftpWrapper._auth_publickey(transport, user, host.get('identityfile', []))
+        password = SftpWrapper._passwords.get(hostname)
+        if not transport.is_authenticated() and password is not None:
+            # A second transport of the host (compression) logs in without asking again
+            try:
+                SftpWrapper._auth_password(transport, user, password, locked_keys)
+            except paramiko.AuthenticationException:
+                SftpWrapper._passwords.remove(hostname, password)
+        return locked_keys
+
+    @staticmethod
+    def _open_socket(hostname, port, tuning):
+        # Buffer sizes only take effect for the TCP window when set before connecting
+        error = OSError('No address for ' + hostname)
+        for family, kind, proto, _, address in socket.getaddrinfo(hostname, port, socket.AF_UNSPEC, socket.SOCK_STREAM):
+            sock = socket.socket(family, kind, proto)
+            try:
+                SftpTuning.apply_socket(sock, tuning)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error
+
+    @staticmethod
+    def _check_host_key(transport, hostname, port):
+        # Unknown hosts are accepted, a changed key is refused
+        host_keys = FileCache.load(os.path.expanduser('~/.ssh/known_hosts'), SftpWrapper._read_host_keys)
+        server_key = transport.get_remote_server_key()
+        name = hostname if port == 22 else '[%s]:%d' % (hostname, port)
+        known = host_keys.lookup(name)
+        if known is not None and server_key.get_name() in known and known[server_key.get_name()] != server_key:
+            raise paramiko.BadHostKeyException(hostname, server_key, known[server_key.get_name()])
+
+    @staticmethod
+    def _auth_publickey(transport, user, identity_files):
+        # Returns the key files that need a passphrase
+        locked_keys = []
+        key_files = [os.path.expanduser(path) for path in identity_files]
+        key_files += [os.path.expanduser('~/.ssh/id_' + name) for name in ('rsa', 'ecdsa', 'ed25519')]
+        keys = []
+        for path in key_files:
+            if path in locked_keys or not os.path.exists(path):
+                continue
+            try:
+                keys.append(SftpWrapper._load_key(path))
+            except paramiko.PasswordRequiredException:
+                locked_keys.append(path)
+            except (IOError, paramiko.SSHException):
+                pass
+        try:
+            keys += paramiko.Agent().get_keys()
+        except paramiko.SSHException:
+            pass
+        for key in keys:
+            try:
+                transport.auth_publickey(user, key)
+            except paramiko.BadAuthenticationType:
+                break
+            except paramiko.AuthenticationException:
+                continue
+            if transport.is_authenticated():
+                break
+        return locked_keys
+
+    @staticmethod
+    def _auth_password(transport, user, password, locked_keys):
+        try:
+            # Falls back to keyboard-interactive if the server asks for it
+            transport.auth_password(user, password)
+        except paramiko.AuthenticationException:
+            # The password may be the passphrase of a key
+            for path in locked_keys:
+                try:
+                    transport.auth_publickey(user, SftpWrapper._load_key(path, password))
+                except (IOError, paramiko.SSHException):
+                    continue
+                if transport.is_authenticated():
+                    return
+            raise
+
+    @staticmethod
+    def _read_host_keys(path):
+        host_keys = paramiko.HostKeys()
+        if os.path.exists(path):
+            host_keys.load(path)
+        return host_keys
+
+    @staticmethod
+    def _load_key(path, password=None):
+        # Decrypted keys are kept, so the passphrase is only needed once
+        return FileCache.load(path, lambda path: SftpWrapper._read_key(path, password))
+
+    @staticmethod
+    def _read_key(path, password):
+        for key_class in (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key, paramiko.DSSKey):
+            try:
+                return key_class.from_private_key_file(path, password)
+            except paramiko.PasswordRequiredException:
+                raise
+            except paramiko.SSHException:
+                continue
+        raise paramiko.SSHException('Unsupported key file ' + path)
 
     def _is_connected(self):
-        return self._host in SftpWrapper._connections and SftpWrapper._connections[self._host].get_channel().get_transport().is_authenticated()
+        connection = SftpWrapper._connections.get(self._host)
+        return connection is not None and SftpBackgroundWrapper._is_alive(connection)
+
+
+class SftpPrewarm():
+    #
+    # Connects in the background to hosts that are likely to be opened
+    # next, so the first listing does not wait for the handshake. A host
+    # that needs a prompt gets only its handshake done; the prompt comes
+    # when the host is actually opened.
+    #
+    _history = None
+    _running = set()
+    _started = False
+    _lock = Lock()
+
+    @staticmethod
+    def start():
+        # Once per session, for the most recently used hosts
+        with SftpPrewarm._lock:
+            if SftpPrewarm._started:
+                return
+            SftpPrewarm._started = True
+        SftpPrewarm.warm_recent()
+
+    @staticmethod
+    def warm_recent():
+        with SftpPrewarm._lock:
+            recent = SftpPrewarm._get_history()[:Config.sftp_prewarm_hosts]
+        for hostname in recent:
+            SftpPrewarm.warm_host(hostname)
+
+    @staticmethod
+    def record(hostname):
+        with SftpPrewarm._lock:
+            history = SftpPrewarm._get_history()
+            if history[:1] != [hostname]:
+                # A new list, so readers of the old one are not disturbed
+                SftpPrewarm._history = [hostname] + [name for name in history if name != hostname][:Config.sftp_history_size - 1]
+                save_json(Config.sftp_history_file, SftpPrewarm._history)
+
+    @staticmethod
+    def warm_host(hostname):
+        if not hostname or hostname == '*' or SftpWrapper.is_warm(hostname):
+            return
+        with SftpPrewarm._lock:
+            if hostname in SftpPrewarm._running:
+                return
+            SftpPrewarm._running.add(hostname)
+        Thread(target=SftpPrewarm._run, args=(hostname,), daemon=True).start()
+
+    @staticmethod
+    def _run(hostname):
+        try:
+            SftpWrapper.warm(hostname)
+        except ValueError:
+            pass
+        finally:
+            with SftpPrewarm._lock:
+                SftpPrewarm._running.discard(hostname)
+
+    @staticmethod
+    def _get_history():
+        # Called with the lock held
+        if SftpPrewarm._history is None:
+            SftpPrewarm._history = list(load_json(Config.sftp_history_file, default=[]))
+        return SftpPrewarm._history
+
+
+class SftpHealthMonitor():
+    #
+    # Looks at the foreground connections every Config.sftp_health_interval
+    # seconds and reconnects dropped ones in the background, so the next
+    # listing finds a working connection. Hosts that would need a prompt
+    # are left alone until the user browses them again.
+    #
+    _thread = None
+    _lock = Lock()
+
+    @staticmethod
+    def start():
+        with SftpHealthMonitor._lock:
+            if SftpHealthMonitor._thread is None:
+                SftpHealthMonitor._thread = Thread(target=SftpHealthMonitor._run, daemon=True)
+                SftpHealthMonitor._thread.start()
+
+    @staticmethod
+    def _run():
+        while True:
+            time.sleep(Config.sftp_health_interval)
+            for host in SftpWrapper._connections.keys():
+                try:
+                    SftpWrapper._reconnect(host)
+                except Exception:
+                    pass
+
+
+def sftp_retry(wrapper, operation, *args, on_retry=None):
+    #
+    # Runs the idempotent operation(wrapper.conn, *args). When the
+    # connection dropped under it, the wrapper reconnects with an
+    # exponential backoff and the operation runs again.
+    #
+    attempt = 0
+    while True:
+        try:
+            return operation(wrapper.conn, *args)
+        except CONNECTION_ERRORS:
+            # Errors on a live connection are the operation's own
+            if wrapper._is_connected():
+                raise
+            while True:
+                if attempt == Config.sftp_retries:
+                    raise
+                time.sleep(Config.sftp_retry_delay * 2 ** attempt)
+                attempt += 1
+                if on_retry:
+                    on_retry()
+                if wrapper.reconnect():
+                    break
+
+
+INTERACTIVE, BULK = range(2)
 
 
 class SftpBackgroundWrapper():
-    def __init__(self, url):
+    #
+    # Background work runs on pooled connections, so the foreground
+    # SftpWrapper connection stays free for browsing. Bulk work shares at
+    # most Config.sftp_bulk_connections per host; interactive work such as
+    # searches never waits for a bulk lane and is served first. Both stay
+    # within the per host maximum of the pool.
+    #
+    _pool = ConnectionPool(
+        close=lambda connection: SftpBackgroundWrapper._close(connection),
+        is_alive=lambda connection: SftpBackgroundWrapper._is_alive(connection),
+        kind_of=lambda connection: connection.get_channel().get_transport().compressed,
+        foreground=SftpWrapper._connections,
+        close_host=lambda host: SftpWrapper._close_host(host))
+
+    def __init__(self, url, priority=BULK, compressible=False):
         _, path = splitscheme(url)
         self._host, self._path = SftpWrapper.parse_path(path)
+        self._priority = priority
+        self._compressible = compressible
         self._background_connection = None
 
     def __enter__(self):
         if not self._host or self._is_connected():
             return self
         try:
-            self._background_connection = SftpWrapper.connection(self._host)
+            self._background_connection = self._acquire()
         except ValueError:
             pass
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        if self._background_connection:
+            # A connection left in an unknown state is not handed out again
+            SftpBackgroundWrapper._pool.release(self._host, self._background_connection, reuse=exc_type is None)
+            self._background_connection = None
+
+    def reconnect(self):
+        # Trades a dropped lane for a new one without prompting, True on success
+        if self._background_connection:
+            SftpBackgroundWrapper._pool.release(self._host, self._background_connection, reuse=False)
+            self._background_connection = None
+        try:
+            self._background_connection = self._acquire(interactive=False)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def get_connection_counts():
+        return SftpBackgroundWrapper._pool.get_counts()
+
+    @staticmethod
+    def close_idle(host):
+        SftpBackgroundWrapper._pool.close_idle(host)
+
+    def _acquire(self, interactive=True):
+        return SftpBackgroundWrapper._pool.acquire(
+            self._host,
+            lambda: SftpWrapper.connection(self._host, self._compressible, interactive),
+            kind=SftpTuning.use_compression(self._host, self._compressible),
+            priority=self._priority,
+            limit=None if self._priority == INTERACTIVE else Config.sftp_bulk_connections)
+
+    @staticmethod
+    def _is_alive(connection):
+        # A session closed by the server can sit on a transport that is still fine
+        channel = connection.get_channel()
+        return not channel.closed and channel.get_transport().is_authenticated()
+
+    @staticmethod
+    def _close(connection):
         try:
-            self._background_connection.close()
+            connection.close()
         except Exception:
             pass
 
@@ -163,4 +866,332 @@ class SftpBackgroundWrapper():
         return self._path
 
     def _is_connected(self):
-        return self._background_connection.get_channel().get_transport().is_authenticated() if self._background_connection else False
+        return SftpBackgroundWrapper._is_alive(self._background_connection) if self._background_connection else False
+
+
+class SftpBatch():
+    #
+    # Queues metadata operations and sends them as pipelined requests.
+    # Every operation is a generator yielding (command, args) and receiving
+    # the reply, so multi-step operations like touch are pipelined too.
+    #
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._operations = []
+        self._pending = {}
+        self._replies = []
+
+    def __len__(self):
+        return len(self._operations)
+
+    def mkdir(self, path, mode=0o777):
+        attr = paramiko.SFTPAttributes()
+        attr.st_mode = mode
+        self._add(self._single(CMD_MKDIR, path, attr))
+
+    def rmdir(self, path):
+        self._add(self._single(CMD_RMDIR, path))
+
+    def remove(self, path):
+        self._add(self._single(CMD_REMOVE, path))
+
+    def rename(self, old_path, new_path):
+        self._add(self._single(CMD_RENAME, old_path, new_path))
+
+    def chmod(self, path, mode):
+        attr = paramiko.SFTPAttributes()
+        attr.st_mode = mode
+        self._add(self._single(CMD_SETSTAT, path, attr))
+
+    def stat(self, path):
+        self._add(self._stat(path))
+
+    def touch(self, path):
+        self._add(self._touch(path))
+
+    def listdir(self, path):
+        self._add(self._listdir(path))
+
+    def run(self):
+        # One result per operation in queue order, failures as exceptions
+        results = [None] * len(self._operations)
+        operations = iter(enumerate(self._operations))
+        self._operations = []
+        for index, operation in operations:
+            self._advance(results, index, operation, None)
+            if len(self._pending) >= Config.sftp_pipeline_depth:
+                break
+        while self._pending:
+            while not self._replies:
+                self._conn._read_response()
+            num, reply = self._replies.pop(0)
+            index, operation = self._pending.pop(num)
+            self._advance(results, index, operation, reply)
+            for index, operation in operations:
+                self._advance(results, index, operation, None)
+                if len(self._pending) >= Config.sftp_pipeline_depth:
+                    break
+        return results
+
+    def _add(self, operation):
+        self._operations.append(operation)
+
+    def _advance(self, results, index, operation, reply):
+        try:
+            if isinstance(reply, Exception):
+                command, args = operation.throw(reply)
+            else:
+                command, args = operation.send(reply)
+        except StopIteration as stop:
+            results[index] = stop.value
+        except (IOError, EOFError) as error:
+            results[index] = error
+        else:
+            num = self._conn._async_request(self, command, *args)
+            self._pending[num] = (index, operation)
+
+    def _async_response(self, t, msg, num):
+        if t == CMD_STATUS:
+            try:
+                self._conn._convert_status(msg)
+            except (IOError, EOFError) as error:
+                self._replies.append((num, error))
+                return
+        self._replies.append((num, (t, msg)))
+
+    def _path(self, path):
+        return self._conn._adjust_cwd(path)
+
+    def _single(self, command, path, *args):
+        args = tuple(self._path(arg) if isinstance(arg, str) else arg for arg in args)
+        yield command, (self._path(path),) + args
+
+    def _stat(self, path):
+        t, msg = yield CMD_STAT, (self._path(path),)
+        if t != CMD_ATTRS:
+            raise IOError('Expected attributes')
+        return paramiko.SFTPAttributes._from_msg(msg)
+
+    def _listdir(self, path):
+        t, msg = yield CMD_OPENDIR, (self._path(path),)
+        if t != CMD_HANDLE:
+            raise IOError('Expected handle')
+        handle = msg.get_binary()
+        entries = []
+        try:
+            while True:
+                t, msg = yield CMD_READDIR, (handle,)
+                if t != CMD_NAME:
+                    raise IOError('Expected name')
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    attr = paramiko.SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in ('.', '..'):
+                        entries.append(attr)
+        except EOFError:
+            pass
+        yield CMD_CLOSE, (handle,)
+        return entries
+
+    def _touch(self, path):
+        flags = SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC | SFTP_FLAG_WRITE
+        t, msg = yield CMD_OPEN, (self._path(path), flags, paramiko.SFTPAttributes())
+        if t != CMD_HANDLE:
+            raise IOError('Expected handle')
+        yield CMD_CLOSE, (msg.get_binary(),)
+
+
+def sftp_walk(conn, path):
+    # Breadth-first walk listing every directory of a level in one batch
+    level = [path]
+    while level:
+        batch = SftpBatch(conn)
+        for dir_path in level:
+            batch.listdir(dir_path)
+        next_level = []
+        for dir_path, entries in zip(level, batch.run()):
+            if isinstance(entries, Exception):
+                continue
+            yield dir_path, entries
+            for attr in entries:
+                if stat.S_ISDIR(attr.st_mode):
+                    next_level.append(posixpath.join(dir_path, attr.filename))
+        level = next_level
+
+
+def sftp_exec(conn, command, allowed=(0,), on_wait=None):
+    # Runs a shell command over an exec channel and returns its output lines.
+    # Exit statuses outside allowed raise OSError, allowed=None takes any.
+    return _exec_lines(sftp_exec_channel(conn, command), allowed, on_wait)
+
+
+def sftp_exec_channel(conn, command, stdin=False):
+    # The command runs after a marker line, which a server that refuses it,
+    # or only runs SFTP for any command, never sends. Without stdin the
+    # command's input is closed right away.
+    channel = conn.get_channel().get_transport().open_session()
+    try:
+        channel.settimeout(Config.sftp_exec_timeout)
+        channel.exec_command(sftp_command('printf', '%s\\n', EXEC_MARKER) + '; ' + command)
+        if not stdin:
+            channel.shutdown_write()
+        marker = b''
+        while not marker.endswith(b'\n') and len(marker) <= len(EXEC_MARKER):
+            data = channel.recv(len(EXEC_MARKER) + 1 - len(marker))
+            if not data:
+                break
+            marker += data
+        if marker != (EXEC_MARKER + '\n').encode():
+            raise ExecUnavailable('The server does not allow remote commands.')
+        channel.settimeout(Config.sftp_timeout)
+    except socket.timeout:
+        channel.close()
+        raise ExecUnavailable('The server does not allow remote commands.')
+    except Exception:
+        channel.close()
+        raise
+    return channel
+
+
+def sftp_exit_status(channel, timeout=None):
+    # None when the command did not exit within timeout (Config.sftp_timeout)
+    if not channel.status_event.wait(Config.sftp_timeout if timeout is None else timeout):
+        return None
+    if channel.exit_status in EXEC_NOT_RUN:
+        raise ExecUnavailable('The command is not available on the server.')
+    return channel.exit_status
+
+
+def _exec_lines(channel, allowed, on_wait):
+    # Reads stdout by line and drains stderr meanwhile, so neither stalls the
+    # channel window; on_wait runs every second without output
+    errors = b''
+    buffer = b''
+    idle = 0
+    try:
+        channel.settimeout(1)
+        while True:
+            try:
+                data = channel.recv(32768)
+            except socket.timeout:
+                data = None
+            while channel.recv_stderr_ready():
+                errors = (errors + channel.recv_stderr(32768))[-4096:]
+                idle = 0
+            if data is None:
+                idle += 1
+                if idle >= Config.sftp_timeout:
+                    raise socket.timeout('No output from the remote command')
+                if on_wait:
+                    on_wait()
+                continue
+            if not data:
+                break
+            idle = 0
+            *lines, buffer = (buffer + data).split(b'\n')
+            for line in lines:
+                yield line.decode('utf-8', 'surrogateescape')
+        if buffer:
+            yield buffer.decode('utf-8', 'surrogateescape')
+        status = sftp_exit_status(channel)
+        while channel.recv_stderr_ready():
+            errors = (errors + channel.recv_stderr(32768))[-4096:]
+        if allowed is not None and status not in allowed:
+            raise OSError(errors.decode('utf-8', 'replace').strip() or 'Remote command failed')
+    finally:
+        channel.close()
+
+
+def sftp_find(conn, path, name='*', size=None, mtime=None):
+    args = ['find', path, '-name', name]
+    if size:
+        args += ['-size', size]
+    if mtime:
+        args += ['-mtime', mtime]
+    try:
+        channel = sftp_exec_channel(conn, sftp_command(*args))
+    except paramiko.SSHException:
+        # Exec is not permitted, filter a pipelined walk instead
+        return _find_walk(conn, path, name, size, mtime)
+    return _find_exec(conn, channel, path, name, size, mtime)
+
+
+def _find_exec(conn, channel, path, name, size, mtime):
+    # Unreadable directories make find fail, its other results still count
+    try:
+        yield from _exec_lines(channel, None, None)
+    except ExecUnavailable:
+        # find itself is missing
+        yield from _find_walk(conn, path, name, size, mtime)
+
+
+def sftp_grep(conn, path, pattern, files_only=False):
+    if files_only:
+        command = sftp_command('grep', '-r', '-I', '-l', '-e', pattern, '--', path)
+    else:
+        command = sftp_command('grep', '-r', '-I', '-n', '--null', '-e', pattern, '--', path)
+    try:
+        channel = sftp_exec_channel(conn, command)
+    except paramiko.SSHException:
+        raise OSError('The server does not allow remote commands.')
+    # Exit status 1 only means that nothing matched
+    return _grep_matches(_exec_lines(channel, (0, 1), None), files_only)
+
+
+def _grep_matches(lines, files_only):
+    # Yields (path, line number, line) tuples, only the path with files_only
+    try:
+        for line in lines:
+            if files_only:
+                yield line, None, None
+            else:
+                remote_path, _, match = line.partition('\0')
+                line_number, _, text = match.partition(':')
+                yield remote_path, line_number, text
+    except ExecUnavailable as e:
+        raise OSError(str(e))
+
+
+def _find_walk(conn, path, name, size, mtime):
+    now = time.time()
+    # find tests the start directory as well, by its base name
+    start = conn.lstat(path)
+    start.filename = posixpath.basename(path.rstrip('/')) or '/'
+    if _find_match(start, name, size, mtime, now):
+        yield path
+    for dir_path, entries in sftp_walk(conn, path):
+        for attr in entries:
+            if _find_match(attr, name, size, mtime, now):
+                yield posixpath.join(dir_path, attr.filename)
+
+
+def _find_match(attr, name, size, mtime, now):
+    if not fnmatch.fnmatchcase(attr.filename, name):
+        return False
+    # Sizes count started units, ages only full days, as with find
+    if size and not _find_compare(size, -(-attr.st_size // _find_size_unit(size))):
+        return False
+    if mtime and not _find_compare(mtime, (now - attr.st_mtime) // 86400):
+        return False
+    return True
+
+
+def _find_size_unit(size):
+    units = {'c': 1, 'w': 2, 'b': 512, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    return units.get(size[-1], 512)
+
+
+def _find_compare(expression, value):
+    # Same semantics as find: +n more than n units, -n less than n, n exactly n
+    number = int(expression.strip('+-').rstrip('cwbkMG'))
+    if expression.startswith('+'):
+        return value > number
+    if expression.startswith('-'):
+        return value < number
+    return value == number
+
+
+def sftp_command(*args):
+    return ' '.join(quote(arg) for arg in args)
@@ -0,0 +1,250 @@
+from collections import deque
+
+from .config import Config
+from .sftp import paramiko, sftp_retry
+
+from paramiko.py3compat import long
+from paramiko.sftp import (CMD_CLOSE, CMD_DATA, CMD_FSTAT, CMD_HANDLE,
+                           CMD_OPEN, CMD_READ, CMD_STATUS, CMD_WRITE,
+                           SFTP_FLAG_CREATE, SFTP_FLAG_READ, SFTP_FLAG_TRUNC,
+                           SFTP_FLAG_WRITE)
+
+#
+# Every file is a generator yielding one of these steps to the queue:
+# SEND a request and get its number back, WAIT for the reply of a request,
+# wait until the file is at the HEAD of the queue, or RELEASE the head.
+#
+SEND, WAIT, HEAD, RELEASE = range(4)
+
+
+class SftpTransferQueue():
+    #
+    # Transfers many files over one SFTP session. The OPEN requests of the
+    # next files and the CLOSE of the previous ones are in flight while
+    # the file at the head of the queue streams its data.
+    #
+
+    def __init__(self, conn, callback=None, done_callback=None):
+        self._conn = conn
+        self._callback = callback
+        self._done_callback = done_callback
+        self._items = []
+        self._replies = {}
+        # Per file, the offset up to which all data has been acknowledged
+        self.offsets = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def upload(self, local_path, remote_path, offset=0):
+        self._items.append((self._upload, local_path, remote_path, offset))
+        self.offsets.append(offset)
+
+    def download(self, remote_path, local_path, offset=0):
+        self._items.append((self._download, remote_path, local_path, offset))
+        self.offsets.append(offset)
+
+    def run(self):
+        # One result per file in queue order, failures as exceptions
+        results = [None] * len(self._items)
+        queue = deque(enumerate(self._items))
+        self._items = []
+        active = []
+        while queue or active:
+            while queue and sum(not entry.released for entry in active) < Config.sftp_open_ahead:
+                index, (transfer, *args) = queue.popleft()
+                active.append(_Transfer(index, transfer(index, *args)))
+            progressed = False
+            head_taken = False
+            for entry in list(active):
+                is_head = not head_taken and not entry.released
+                head_taken = head_taken or not entry.released
+                if self._step(entry, is_head, results):
+                    progressed = True
+                if entry.done:
+                    active.remove(entry)
+            if not progressed:
+                self._conn._read_response()
+        return results
+
+    def _step(self, entry, is_head, results):
+        progressed = False
+        while True:
+            if entry.waiting is not None:
+                if entry.waiting not in self._replies:
+                    return progressed
+                entry.value = self._replies.pop(entry.waiting)
+                entry.waiting = None
+            elif entry.at_head and not is_head:
+                return progressed
+            progressed = True
+            value, entry.value, entry.at_head = entry.value, None, False
+            try:
+                if isinstance(value, Exception):
+                    step, arg = entry.transfer.throw(value)
+                else:
+                    step, arg = entry.transfer.send(value)
+            except StopIteration:
+                entry.done = True
+                if self._done_callback:
+                    self._done_callback(entry.index)
+                return progressed
+            except (IOError, EOFError) as error:
+                results[entry.index] = error
+                entry.done = True
+                return progressed
+            if step == SEND:
+                command, args = arg
+                entry.value = self._conn._async_request(self, command, *args)
+            elif step == WAIT:
+                entry.waiting = arg
+            elif step == HEAD:
+                entry.at_head = True
+            elif step == RELEASE:
+                entry.released = True
+                is_head = False
+
+    def _async_response(self, t, msg, num):
+        if t == CMD_STATUS:
+            try:
+                self._conn._convert_status(msg)
+            except (IOError, EOFError) as error:
+                self._replies[num] = error
+                return
+        self._replies[num] = (t, msg)
+
+    def _progress(self, index, size):
+        if self._callback:
+            self._callback(index, size)
+
+    def _acknowledge(self, index, size):
+        self.offsets[index] += size
+        self._progress(index, size)
+
+    def _open(self, remote_path, flags):
+        num = yield SEND, (CMD_OPEN, (self._conn._adjust_cwd(remote_path), flags, paramiko.SFTPAttributes()))
+        t, msg = yield WAIT, num
+        if t != CMD_HANDLE:
+            raise IOError('Expected handle')
+        return msg.get_binary()
+
+    def _close(self, handle):
+        num = yield SEND, (CMD_CLOSE, (handle,))
+        yield RELEASE, None
+        yield WAIT, num
+
+    def _upload(self, index, local_path, remote_path, offset):
+        # A resumed upload keeps what the server already acknowledged
+        flags = SFTP_FLAG_CREATE | SFTP_FLAG_WRITE | (0 if offset else SFTP_FLAG_TRUNC)
+        handle = yield from self._open(remote_path, flags)
+        yield HEAD, None
+        try:
+            with open(local_path, 'rb') as local_file:
+                local_file.seek(offset)
+                pending = deque()
+                while True:
+                    data = local_file.read(Config.sftp_chunk_size)
+                    if not data:
+                        break
+                    num = yield SEND, (CMD_WRITE, (handle, long(offset), data))
+                    pending.append((num, len(data)))
+                    offset += len(data)
+                    if len(pending) >= Config.sftp_pipeline_depth:
+                        num, size = pending.popleft()
+                        yield WAIT, num
+                        self._acknowledge(index, size)
+                while pending:
+                    num, size = pending.popleft()
+                    yield WAIT, num
+                    self._acknowledge(index, size)
+        except (IOError, EOFError):
+            yield from self._close(handle)
+            raise
+        yield from self._close(handle)
+
+    def _download(self, index, remote_path, local_path, start):
+        handle = yield from self._open(remote_path, SFTP_FLAG_READ)
+        try:
+            # The size of the open file, a listed size may be out of date
+            t, msg = yield WAIT, (yield SEND, (CMD_FSTAT, (handle,)))
+            size = paramiko.SFTPAttributes._from_msg(msg).st_size
+            yield HEAD, None
+            with open(local_path, 'r+b' if start else 'wb') as local_file:
+                chunk_size = Config.sftp_chunk_size
+                ranges = deque((offset, min(chunk_size, size - offset)) for offset in range(start, size, chunk_size))
+                # Written pieces past the acknowledged offset, start -> end
+                written = {}
+                pending = deque()
+                while ranges or pending:
+                    while ranges and len(pending) < Config.sftp_pipeline_depth:
+                        offset, length = ranges.popleft()
+                        num = yield SEND, (CMD_READ, (handle, long(offset), int(length)))
+                        pending.append((num, offset, length))
+                    num, offset, length = pending.popleft()
+                    try:
+                        t, msg = yield WAIT, num
+                    except EOFError:
+                        # The file got shorter since it was listed
+                        continue
+                    if t != CMD_DATA:
+                        raise IOError('Expected data')
+                    data = msg.get_string()
+                    local_file.seek(offset)
+                    local_file.write(data)
+                    if 0 < len(data) < length:
+                        ranges.appendleft((offset + len(data), length - len(data)))
+                    self._progress(index, len(data))
+                    written[offset] = offset + len(data)
+                    while self.offsets[index] in written:
+                        self.offsets[index] = written.pop(self.offsets[index])
+        except (IOError, EOFError):
+            yield from self._close(handle)
+            raise
+        yield from self._close(handle)
+
+
+def resumable_transfer(sftp, items, callback=None, done_callback=None, on_retry=None):
+    #
+    # Runs ('upload', local, remote) and ('download', remote, local)
+    # items over the connection of sftp. When the connection drops it is
+    # opened again and every unfinished file resumes at its last
+    # acknowledged offset. Results and callbacks use item indexes.
+    #
+    results = [None] * len(items)
+    offsets = [0] * len(items)
+    done = set()
+
+    def file_done(index):
+        done.add(index)
+        if done_callback:
+            done_callback(index)
+
+    def run(conn):
+        pending = [index for index in range(len(items)) if index not in done and results[index] is None]
+        queue = SftpTransferQueue(
+            conn,
+            callback=callback and (lambda position, size: callback(pending[position], size)),
+            done_callback=lambda position: file_done(pending[position]))
+        for index in pending:
+            kind, *args = items[index]
+            getattr(queue, kind)(*args, offset=offsets[index])
+        try:
+            for index, result in zip(pending, queue.run()):
+                results[index] = result
+        finally:
+            for index, offset in zip(pending, queue.offsets):
+                offsets[index] = offset
+        return results
+
+    return sftp_retry(sftp, run, on_retry=on_retry)
+
+
+class _Transfer():
+    def __init__(self, index, transfer):
+        self.index = index
+        self.transfer = transfer
+        self.value = None
+        self.waiting = None
+        self.at_head = False
+        self.released = False
+        self.done = False
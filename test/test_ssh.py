@@ -0,0 +1,149 @@
+import os
+import socket
+import struct
+import sys
+import unittest
+
+#
+# Known-answer and round-trip tests of the AEAD ciphers in ssh.py. Run
+# with: python -m unittest discover test
+#
+try:
+    import paramiko
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+    import paramiko
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'sftp_plugin'))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.poly1305 import Poly1305
+from paramiko.message import Message
+
+from ssh import AEAD_CIPHERS, TAG_SIZE, AeadPacketizer, AesGcm, ChaChaPoly
+
+# First 64 bytes of the ChaCha20 key stream for an all zero key and nonce
+# (draft-agl-tls-chacha20poly1305, test vector 1)
+CHACHA20_ZERO_BLOCK = bytes.fromhex(
+    '76b8e0ada0f13d90405d6ae55386bd28bdd219b8a08ded1aa836efcc8b770dc7'
+    'da41597c5157488d7724e03fb8d84a376a43b8f41518a11cc387b669b2ee6586')
+
+
+def packet(payload):
+    # Length, padding length, payload and padding, as the packetizer builds it
+    padding = 16 - (len(payload) + 1) % 16 + 16
+    body = bytes([padding]) + payload + bytes(padding)
+    return struct.pack('>I', len(body)) + body
+
+
+class AesGcmTest(unittest.TestCase):
+    def test_nonce_is_fixed_field_and_invocation_counter(self):
+        key, iv = os.urandom(16), bytes(range(12))
+        engine = AesGcm(key, iv)
+        data = packet(b'hello')
+        for counter in (0x0405060708090a0b, 0x0405060708090a0c):
+            nonce = iv[:4] + struct.pack('>Q', counter)
+            expected = data[:4] + AESGCM(key).encrypt(nonce, data[4:], data[:4])
+            self.assertEqual(engine.seal(0, data), expected)
+
+    def test_counter_wraps_at_64_bits(self):
+        iv = bytes(4) + b'\xff' * 8
+        engine = AesGcm(bytes(16), iv)
+        engine.seal(0, packet(b'x'))
+        self.assertEqual(engine._next_nonce(), bytes(12))
+
+    def test_round_trip_and_length_in_clear(self):
+        key, iv = os.urandom(32), os.urandom(12)
+        data = packet(b'payload')
+        sealed = AesGcm(key, iv).seal(3, data)
+        self.assertEqual(sealed[:4], data[:4])
+        self.assertEqual(len(sealed), len(data) + TAG_SIZE)
+        receiver = AesGcm(key, iv)
+        self.assertEqual(receiver.packet_length(3, sealed[:4]), len(data) - 4)
+        self.assertEqual(receiver.open(3, sealed[:4], sealed[4:]), data[4:])
+
+    def test_tampered_length_is_rejected(self):
+        key, iv = os.urandom(16), os.urandom(12)
+        sealed = bytearray(AesGcm(key, iv).seal(0, packet(b'payload')))
+        sealed[3] ^= 1
+        with self.assertRaises(Exception):
+            AesGcm(key, iv).open(0, bytes(sealed[:4]), bytes(sealed[4:]))
+
+
+class ChaChaPolyTest(unittest.TestCase):
+    def test_known_answer(self):
+        # All zero keys and sequence number 0: the length is encrypted with
+        # the start of the key stream, which is also the Poly1305 key
+        data = packet(b'known answer')
+        sealed = ChaChaPoly(bytes(64), b'').seal(0, data)
+        length = bytes(a ^ b for a, b in zip(data[:4], CHACHA20_ZERO_BLOCK))
+        self.assertEqual(sealed[:4], length)
+        poly = Poly1305(CHACHA20_ZERO_BLOCK[:32])
+        poly.update(sealed[:-TAG_SIZE])
+        self.assertEqual(sealed[-TAG_SIZE:], poly.finalize())
+
+    def test_sequence_number_changes_the_stream(self):
+        key = os.urandom(64)
+        data = packet(b'same payload')
+        engine = ChaChaPoly(key, b'')
+        self.assertNotEqual(engine.seal(0, data), engine.seal(1, data))
+
+    def test_round_trip(self):
+        key = os.urandom(64)
+        data = packet(b'payload' * 100)
+        sealed = ChaChaPoly(key, b'').seal(7, data)
+        receiver = ChaChaPoly(key, b'')
+        self.assertEqual(receiver.packet_length(7, sealed[:4]), len(data) - 4)
+        self.assertEqual(receiver.open(7, sealed[:4], sealed[4:]), data[4:])
+
+    def test_tampered_tag_is_rejected(self):
+        key = os.urandom(64)
+        sealed = bytearray(ChaChaPoly(key, b'').seal(0, packet(b'payload')))
+        sealed[-1] ^= 1
+        with self.assertRaises(Exception):
+            ChaChaPoly(key, b'').open(0, bytes(sealed[:4]), bytes(sealed[4:]))
+
+
+class AeadPacketizerTest(unittest.TestCase):
+    def _use(self, name):
+        # A sender and a receiver packetizer on both ends of a socket pair
+        left, right = socket.socketpair()
+        for sock in (left, right):
+            sock.settimeout(5)
+            self.addCleanup(sock.close)
+        self.sender, self.receiver = AeadPacketizer(left), AeadPacketizer(right)
+        info = AEAD_CIPHERS[name]
+        key, iv = os.urandom(info['key-size']), os.urandom(12)
+        self.sender.set_outbound_cipher(info['class'](key, iv), info['block-size'], None, 0, b'')
+        self.receiver.set_inbound_cipher(info['class'](key, iv), info['block-size'], None, 0, b'')
+        return left
+
+    def _message(self, text):
+        message = Message()
+        message.add_byte(bytes([paramiko.common.MSG_IGNORE]))
+        message.add_string(text)
+        return message
+
+    def test_round_trip(self):
+        for name in AEAD_CIPHERS:
+            with self.subTest(name):
+                self._use(name)
+                for text in (b'', b'first', b'x' * 5000):
+                    self.sender.send_message(self._message(text))
+                    command, message = self.receiver.read_message()
+                    self.assertEqual(command, paramiko.common.MSG_IGNORE)
+                    self.assertEqual(message.get_binary(), text)
+
+    def test_tampered_tag_is_rejected(self):
+        for name in AEAD_CIPHERS:
+            with self.subTest(name):
+                sock = self._use(name)
+                sent = []
+                self.sender.write_all = sent.append
+                self.sender.send_message(self._message(b'payload'))
+                sock.sendall(sent[0][:-1] + bytes([sent[0][-1] ^ 1]))
+                with self.assertRaises(paramiko.SSHException):
+                    self.receiver.read_message()
+
+
+if __name__ == '__main__':
+    unittest.main()